@@ -0,0 +1,49 @@
+
+"""Benchmark for manifest save and load, showing how they scale with the number of lines.
+Run from the repository root as: python benchmarks/manifest_io.py [SIZE ...]
+Time per line should stay roughly constant as the size grows.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+# running this file puts benchmarks/ on the path, not the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from restore.handlers.basics import BasicFileHandler
+from restore.manifest import Manifest, HandlerRecord
+
+
+def make_manifest(size):
+	manifest = Manifest(absolute=True)
+	for i in xrange(size):
+		manifest.files['/home/user/dir{}/file{}'.format(i % 1000, i)] = HandlerRecord(BasicFileHandler)
+	return manifest
+
+
+def timed(fn, *args):
+	start = time.time()
+	fn(*args)
+	return time.time() - start
+
+
+def main(sizes):
+	fd, path = tempfile.mkstemp()
+	os.close(fd)
+	try:
+		print "{:>10} {:>10} {:>12} {:>10} {:>12}".format('lines', 'save (s)', 'us/line', 'load (s)', 'us/line')
+		for size in sizes:
+			manifest = make_manifest(size)
+			save = timed(manifest.savefile, path)
+			load = timed(Manifest, path)
+			print "{:>10} {:>10.3f} {:>12.3f} {:>10.3f} {:>12.3f}".format(
+				size, save, 1e6 * save / size, load, 1e6 * load / size,
+			)
+	finally:
+		os.remove(path)
+
+
+if __name__ == '__main__':
+	main(map(int, sys.argv[1:]) or [10000, 100000, 1000000])
@@ -0,0 +1,88 @@
+/* Optional C implementation of the chunk boundary scan in chunkstore.find_cut().
+ * The pure python version hashes a few MB/s, which is far too slow for large files.
+ * This must give exactly the same results, so the hash table is passed in from python
+ * rather than duplicated here.
+ */
+
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+#include <stdint.h>
+#include <string.h>
+
+#if PY_MAJOR_VERSION >= 3
+#define BYTES_FORMAT "y*"
+#else
+#define BYTES_FORMAT "s*"
+#endif
+
+PyDoc_STRVAR(find_cut_doc,
+"find_cut(data, start, end, table, mask) -> int\n\n"
+"Run a Gear rolling hash over data[start:end], starting from a hash of 0, using table\n"
+"(256 native-endian uint64s). Returns the index just after the first byte where the hash\n"
+"has no bits of mask set, or end if there is none.");
+
+static PyObject *
+find_cut(PyObject *self, PyObject *args)
+{
+	Py_buffer data, table;
+	Py_ssize_t start, end, i;
+	unsigned long long mask;
+	uint64_t gear[256];
+	uint64_t h = 0;
+	const unsigned char *bytes;
+
+	if (!PyArg_ParseTuple(args, BYTES_FORMAT "nn" BYTES_FORMAT "K", &data, &start, &end, &table, &mask))
+		return NULL;
+	if (table.len != sizeof(gear)) {
+		PyErr_SetString(PyExc_ValueError, "table must be 256 uint64s");
+		goto error;
+	}
+	if (start < 0 || end > data.len || start > end) {
+		PyErr_SetString(PyExc_ValueError, "start and end out of range");
+		goto error;
+	}
+	memcpy(gear, table.buf, sizeof(gear));
+	bytes = (const unsigned char *)data.buf;
+
+	Py_BEGIN_ALLOW_THREADS
+	for (i = start; i < end; i++) {
+		h = (h << 1) + gear[bytes[i]];
+		if (!(h & mask)) {
+			i++;
+			break;
+		}
+	}
+	Py_END_ALLOW_THREADS
+
+	PyBuffer_Release(&data);
+	PyBuffer_Release(&table);
+	return PyLong_FromSsize_t(i);
+
+error:
+	PyBuffer_Release(&data);
+	PyBuffer_Release(&table);
+	return NULL;
+}
+
+static PyMethodDef gear_methods[] = {
+	{"find_cut", find_cut, METH_VARARGS, find_cut_doc},
+	{NULL, NULL, 0, NULL}
+};
+
+#if PY_MAJOR_VERSION >= 3
+static struct PyModuleDef gear_module = {
+	PyModuleDef_HEAD_INIT, "_gear", NULL, -1, gear_methods
+};
+
+PyMODINIT_FUNC
+PyInit__gear(void)
+{
+	return PyModule_Create(&gear_module);
+}
+#else
+PyMODINIT_FUNC
+init_gear(void)
+{
+	Py_InitModule("_gear", gear_methods);
+}
+#endif
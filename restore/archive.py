@@ -1,11 +1,26 @@
 
+import logging
 import os
 import stat
 import time
-from cStringIO import StringIO
-from tarfile import TarFile, DIRTYPE, REGTYPE
+from itertools import chain
+from tarfile import TarFile, BLOCKSIZE, DIRTYPE, REGTYPE, LNKTYPE, PAX_FORMAT, DEFAULT_FORMAT
+from tempfile import SpooledTemporaryFile
 
+import gevent
+from gevent.event import Event
+from gevent.monkey import get_original
+
+from chunkstore import ChunkStore, STORE_MIN_SIZE
+from compression import ParallelBlockWriter, get_codec, open_reader
+from depgraph import DependencyGraph
 from manifest import Manifest
+from pipeline import collect_extra_data
+from streams import open_stream, close_stream, close_values, copy_stream, stream_size, SPOOL_MAX_MEMORY
+from streams import FileRange, FixedSizeReader, HashingReader, LockedReader, hash_stream, make_seekable
+
+
+logger = logging.getLogger('restore.archive')
 
 
 class Archive(object):
@@ -13,35 +28,137 @@ class Archive(object):
 	needed to fully restore the listed files.
 	As the emphasis is on not storing the whole archive in memory at once, you must pass a file
 	object to the constructor to be written to/read from.
-	When reading an archive, the given file object must be seekable.
+	When reading an archive, the given file object must be seekable, unless stream=True is given.
 	A file object need not be seekable when writing.
-	Archives are gzip-compressed by default. Pass compress='bz2' to use bzip, or None to disable.
-	When reading, compression is auto-detected.
+	The manifest is always written first, followed by each path's extra data in dependency order
+	(see DependencyGraph.order()). This allows a stream reader to restore each path as soon as
+	its data and dependencies have arrived, without needing to seek. The dependencies themselves are
+	also stored, so readers don't need to work them out again.
+	Archives are gzip-compressed by default. Pass compress as one of 'bz2', 'zstd' or 'lz4' to use those
+	instead (see compression.CODECS), or None to disable. Compression is done using multiple threads,
+	see compression.COMPRESS_THREADS_MAX. When reading, compression is auto-detected.
+	Pass dedup=True when writing to store each distinct value only once. Repeated values are written as
+	hard links to the first copy, which are resolved transparently when reading. Note that such archives
+	cannot be read with stream=True.
+	Archives may be incremental, in which case data for paths that haven't changed since a previous "base"
+	archive are not stored, and are instead read from the base archive (which may itself be incremental).
+	This is determined by the fingerprints stored in each archive, see Manifest.get_fingerprints().
+	Pass a ChunkStore as chunkstore when writing to store large values in the chunk store, with only
+	the list of chunks stored in the archive. These members are marked with a pax header.
+	When reading, the chunk store the archive was written with is used unless another is given.
+	Unless compressed with zstd (which isn't written in independent blocks), archives end with an index of
+	every member and where each compressed block starts, followed by a trailer giving the location of the index.
+	Readers use this to read only the parts of the archive they need, see load_index().
 	Can be used as a context manager, closing on exit, similar to a file object.
 	"""
 	# cache for the listing of files in the archive
 	# in the read case, cache means no need to re-read every time
 	# in the write case, cache tracks what paths we've written since we can't read back to check later
 	_names = None
+	# in the read case, maps member names to TarInfo objects, so lookups don't need to scan the archive
+	_members = None
+	# in the read case, maps archive directory paths to {key: TarInfo} for the extra data under them
+	_index = None
+	# in the stream read case, the manifest read from the start of the stream
+	_manifest = None
+	# in the read case, maps path to fingerprint for all fingerprinted paths
+	_fingerprints = None
+	# in the read case, maps path to dependencies for paths with other than the default dependencies
+	# (see DependencyGraph.get_overrides()), or None for archives which don't store them
+	_depends = None
+	# in the stream read case, the dependency graph of the manifest
+	_graph = None
+	# in the read case for an incremental archive, the location of the base archive (and its absolute location
+	# when it was written, if known), the set of paths whose data is in the base archive, and the base archive once opened
+	_base_ref = None
+	_base_abspath = None
+	_in_base = frozenset()
+	_base = None
+	# the path of the archive file, if known. Relative base archive refs are relative to this.
+	filepath = None
+	# if set, relative base archive refs are relative to this directory instead, eg. for archives read from stdin
+	base_dir = None
+	# in the read case, the location of the chunk store the archive was written with, if any
+	_chunkstore_path = None
+	# in the write case, (name, type, data offset, size, linkname, chunked) of each member written so far,
+	# or None if the archive won't have an index.
+	_written = None
+	# in the stream read case, the archive paths whose data is wanted, or None for all of them
+	_stream_wanted = None
+
+	# metadata members which may follow the manifest, in order
+	HEADER_MEMBERS = ('fingerprints', 'base', 'chunkstore', 'depends')
+	# pax header which marks a member as containing a list of chunks in the chunk store
+	CHUNKED_HEADER = 'RESTORE.chunked'
+	# the trailer is a separately compressed frame at the very end of the file, containing this prefix
+	# followed by the uncompressed and compressed offsets of the index member
+	TRAILER_PREFIX = 'restore-index '
+	# how far from the end of the file to look for the trailer
+	TRAILER_SEARCH_SIZE = 512
 
 	@classmethod
-	def from_file(cls, filepath):
+	def from_file(cls, filepath, stream=False, chunkstore=None):
 		fileobj = open(filepath)
-		return cls(fileobj, 'r')
+		archive = cls(fileobj, 'r', stream=stream, chunkstore=chunkstore)
+		archive.filepath = filepath
+		return archive
 
-	def __init__(self, file, mode, compress='gz'):
+	def __init__(self, file, mode, compress='gz', stream=False, dedup=False, chunkstore=None,
+	             compress_level=None, compress_threads=None):
 		"""Open given file object as an archive. Mode must be one of 'r' or 'w' when reading or writing
 		respectively.
+		compress_level and compress_threads override the defaults for the chosen compression.
+		If stream=True when reading, the file is read strictly in order, which allows it to be a pipe
+		or other non-seekable file. In this mode, only get_manifest(), get_extra_data() and restore()
+		may be used, and extra data for each path can only be retrieved once.
 		This module does not support appending to existing archives."""
+		self.stream = stream
+		self.dedup = dedup
+		# in the dedup write case, maps {(size, chunked): {hash: member name}} for all values written so far
+		self._blobs = {}
+		self.chunkstore = chunkstore
+		# in the read case, we only pass on an explicitly given chunk store to base archives
+		self._chunkstore_given = chunkstore
+		# we do compression ourselves rather than leaving it to tarfile, so it can use multiple cores.
+		# compressor is the file object which compresses the tar stream into file, if any.
+		self.compressor = None
+		# held while reading from the underlying file, which may happen from multiple threads.
+		# This needs to be a real lock even if threading is monkey-patched, since gevent locks don't work across threads.
+		self.read_lock = get_original('thread', 'allocate_lock')()
+		self.codec = None
+		# the underlying file, before any compression
+		self.rawfile = file
 		if mode == 'r':
-			pass
+			self.codec, file = open_reader(file)
+			codec = self.codec
+			tarmode = 'r|' if stream else 'r:'
+			# an uncompressed archive is read directly, so members can be read in any order cheaply.
+			# otherwise, seeking backwards means decompressing again from the start.
+			self.random_access = codec is None
 		elif mode == 'w':
-			mode = 'w|{}'.format(compress or '')
+			tarmode = 'w|'
+			if compress:
+				self.codec = get_codec(compress)
+				self.compressor = self.codec.open_writer(file, compress_level, compress_threads)
+				file = self.compressor
+			if self.compressor is None or isinstance(self.compressor, ParallelBlockWriter):
+				self._written = []
+			if isinstance(self.compressor, ParallelBlockWriter):
+				# tarfile's stream mode buffers what it writes, so we couldn't end a block at the index.
+				# Non-stream mode writes straight through, and only needs tell() from the compressor.
+				tarmode = 'w:'
 		else:
 			raise ValueError("mode must be one of 'r', 'w': got {!r}".format(mode))
-		self.tar = TarFile.open(fileobj=file, mode=mode)
+		# pax format is needed to mark chunked members
+		tarformat = PAX_FORMAT if chunkstore is not None else DEFAULT_FORMAT
+		self.tar = TarFile.open(fileobj=file, mode=tarmode, format=tarformat)
 		# we use this value to set "modified" times without doing lots of unneeded time checks
 		self.create_time = time.time()
+		if mode == 'r':
+			if stream:
+				self.read_stream_manifest()
+			elif not self.load_index():
+				self.build_index()
 
 	# --- common methods ---
 
@@ -55,8 +172,26 @@ class Archive(object):
 		                for part in path.split('/'))
 		return "data/{}".format(path)
 
+	@staticmethod
+	def split_member(name):
+		"""For an archive member name, return (archive path, key) if it is an extra data file,
+		or (None, None) otherwise. Note that escaped path parts always start with '__' but keys never do."""
+		dirname, key = os.path.split(name)
+		if key.startswith('_') and not key.startswith('__'):
+			return dirname, key[1:] # strip leading '_'
+		return None, None
+
 	def close(self):
+		if self._base is not None:
+			self._base.close()
+		trailer = None
+		if self._written is not None:
+			trailer = self.write_index()
 		self.tar.close()
+		if self.compressor is not None:
+			self.compressor.close()
+		if trailer is not None:
+			self.rawfile.write(trailer)
 
 	def __enter__(self):
 		return self
@@ -66,46 +201,384 @@ class Archive(object):
 
 	# --- read methods ---
 
+	def build_index(self, members=None):
+		"""Index the given TarInfo objects by name, and index extra data by the directory it is stored under.
+		Members default to reading all members of the archive in a single pass."""
+		if members is None:
+			members = self.tar.getmembers()
+		self._members = {}
+		self._index = {}
+		for tarinfo in members:
+			self._members[tarinfo.name] = tarinfo
+			dirname, key = self.split_member(tarinfo.name)
+			if key is not None:
+				self._index.setdefault(dirname, {})[key] = self.resolve(tarinfo)
+		self._names = set(self._members)
+		for name in self.HEADER_MEMBERS:
+			if name in self._members:
+				self.read_header(name, self.open(name))
+		if self._fingerprints is None:
+			self._fingerprints = {}
+
+	def load_index(self):
+		"""Build our index (see build_index()) from the index member written at the end of the archive,
+		without reading the rest of the archive. For compressed archives, the reader is also told where each
+		compressed block starts, so that reading a member only decompresses from the block it starts in.
+		Returns False if the archive has no index."""
+		trailer = self.find_trailer()
+		if trailer is None:
+			return False
+		index_offset, index_compressed_offset = trailer
+		fileobj = self.tar.fileobj
+		if self.codec is not None:
+			fileobj.set_blocks([(index_offset, index_compressed_offset)])
+		# skip straight to the index member. Seeking first means tarfile doesn't need to check the previous byte.
+		fileobj.seek(index_offset)
+		self.tar.firstmember = None
+		self.tar.offset = index_offset
+		tarinfo = self.tar.next()
+		if tarinfo is None or tarinfo.name != 'index':
+			raise ValueError("Bad archive: Trailer does not point to the index")
+		blocks = []
+		members = []
+		for line in self.tar.extractfile(tarinfo):
+			parts = line.rstrip('\n').split('\t')
+			if parts[0] == 'block':
+				blocks.append((int(parts[1]), int(parts[2])))
+			elif parts[0] == 'member':
+				name, type, offset_data, size, linkname, chunked = parts[1:]
+				member = self.tar.tarinfo(name.decode('string-escape'))
+				member.tarfile = self.tar
+				member.type = type
+				member.offset = member.offset_data = int(offset_data)
+				member.size = int(size)
+				member.linkname = linkname.decode('string-escape')
+				if chunked == '1':
+					member.pax_headers = {self.CHUNKED_HEADER: '1'}
+				members.append(member)
+		if self.codec is not None:
+			fileobj.set_blocks(blocks + [(index_offset, index_compressed_offset)])
+		self.build_index(members)
+		return True
+
+	def find_trailer(self):
+		"""Returns (offset, compressed offset) of the index member, as given by the trailer at the end
+		of the file, or None if there isn't one (eg. for archives written before indexes existed)."""
+		try:
+			position = self.rawfile.tell()
+			self.rawfile.seek(0, 2)
+			end = self.rawfile.tell()
+			self.rawfile.seek(max(0, end - self.TRAILER_SEARCH_SIZE))
+			tail = self.rawfile.read()
+			self.rawfile.seek(position)
+		except (AttributeError, IOError):
+			return None
+		if self.codec is None:
+			# the trailer is the last line, after the tar padding
+			candidates = [tail[max(tail.rfind('\n', 0, -1), tail.rfind('\0')) + 1:]]
+		else:
+			# the trailer frame starts at one of the occurences of the codec's magic bytes.
+			# Check each one, starting from the end.
+			candidates = []
+			start = len(tail)
+			while True:
+				start = tail.rfind(self.codec.magic, 0, start)
+				if start < 0:
+					break
+				try:
+					decompressor = self.codec.decompressor()
+					text = decompressor.decompress(tail[start:])
+					if self.codec.unused_data(decompressor):
+						continue
+				except Exception:
+					continue
+				candidates.append(text)
+		for text in candidates:
+			if not (text.startswith(self.TRAILER_PREFIX) and text.endswith('\n')):
+				continue
+			offsets = text[len(self.TRAILER_PREFIX):].split()
+			if len(offsets) == 2 and all(offset.isdigit() for offset in offsets):
+				return tuple(map(int, offsets))
+		return None
+
+	def read_header(self, name, fileobj):
+		"""Parse one of the metadata members which are stored immediately after the manifest,
+		given a file object to read it from line by line."""
+		lines = (line.rstrip('\n') for line in fileobj)
+		lines = (line for line in lines if line)
+		if name == 'fingerprints':
+			self._fingerprints = {}
+			for line in lines:
+				path, fingerprint = line.split('\t', 1)
+				self._fingerprints[path.decode('string-escape')] = fingerprint
+		elif name == 'base':
+			# the location may be followed by a tab and the absolute location, see add_manifest()
+			self._base_ref, _, self._base_abspath = next(lines).partition('\t')
+			self._in_base = set(path.decode('string-escape') for path in lines)
+		elif name == 'chunkstore':
+			self._chunkstore_path = next(lines)
+		elif name == 'depends':
+			self._depends = {}
+			for line in lines:
+				parts = [part.decode('string-escape') for part in line.split('\t')]
+				self._depends[parts[0]] = parts[1:]
+
+	def get_fingerprints(self):
+		"""Returns a dict {path: fingerprint} as recorded when the archive was written."""
+		return self._fingerprints
+
+	def is_incremental(self):
+		return self._base_ref is not None
+
+	def get_base(self):
+		"""For an incremental archive, return the base archive, opening it if needed.
+		The recorded location is relative to base_dir if set, or else the directory containing this archive
+		(or the current directory, if that isn't known). If there's no archive there, we fall back to
+		the base archive's absolute location when this archive was written."""
+		if self._base is None:
+			if self.base_dir is not None:
+				candidates = [os.path.join(self.base_dir, self._base_ref)]
+			elif self.filepath is not None:
+				candidates = [os.path.join(os.path.dirname(self.filepath), self._base_ref)]
+			else:
+				candidates = [self._base_ref]
+			if self._base_abspath:
+				candidates.append(self._base_abspath)
+			for candidate in candidates:
+				if os.path.isfile(candidate):
+					break
+			else:
+				raise ValueError("Base archive {!r} of incremental archive not found, tried: {}".format(
+					self._base_ref, ", ".join(map(repr, candidates)),
+				))
+			self._base = Archive.from_file(candidate, chunkstore=self._chunkstore_given)
+		return self._base
+
+	def get_chunkstore(self):
+		"""Returns the chunk store to read chunked members from."""
+		if self.chunkstore is None:
+			if self._chunkstore_path is None:
+				raise ValueError("Bad archive: Archive contains chunked data, but no chunk store is known")
+			self.chunkstore = ChunkStore(self._chunkstore_path)
+		return self.chunkstore
+
+	def is_chunked(self, tarinfo):
+		return bool(tarinfo.pax_headers.get(self.CHUNKED_HEADER))
+
+	def open_chunked(self, tarinfo):
+		"""For a chunked member, returns a file-like object which reads the data from the chunk store."""
+		digests = self.tar.extractfile(tarinfo).read().split()
+		return self.get_chunkstore().open(digests)
+
+	def get_chunk_refs(self):
+		"""Returns the set of hashes of all chunks used by this archive (not including any base archive)."""
+		refs = set()
+		members = sorted(self._members.values(), key=lambda tarinfo: tarinfo.offset_data)
+		for tarinfo in members:
+			if tarinfo.isfile() and self.is_chunked(tarinfo):
+				refs.update(self.tar.extractfile(tarinfo).read().split())
+		return refs
+
+	def getmember(self, path):
+		"""Returns the TarInfo for given file in the tar file. Raises KeyError if not present."""
+		return self._members[path]
+
+	def resolve(self, tarinfo):
+		"""For a hard link (ie. deduplicated value), returns the TarInfo of the member it links to.
+		Otherwise returns tarinfo unchanged."""
+		if not tarinfo.islnk():
+			return tarinfo
+		# links always refer to an earlier member, so it's already been indexed
+		if tarinfo.linkname not in self._members:
+			raise ValueError("Bad archive: {!r} links to missing member {!r}".format(tarinfo.name, tarinfo.linkname))
+		return self._members[tarinfo.linkname]
+
 	def read(self, path):
 		"""Returns the data for given file in the tar file"""
-		return self.tar.extractfile(path).read()
+		return self.open(path).read()
+
+	def open(self, path):
+		"""Returns a read-only file-like object for given file in the tar file"""
+		tarinfo = self.resolve(self.getmember(path))
+		if self.is_chunked(tarinfo):
+			return self.open_chunked(tarinfo)
+		return self.tar.extractfile(tarinfo)
+
+	def spool(self, fileobj):
+		"""Copy fileobj to a temporary file, which is only kept in memory if small, and return it."""
+		spool = SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+		copy_stream(fileobj, spool)
+		spool.seek(0)
+		return spool
 
 	def get_names(self):
-		if self._names is None:
-			self._names = set(self.tar.getnames())
 		return self._names
 
 	def get_manifest(self):
+		if self.stream:
+			return self._manifest
 		manifest = Manifest()
-		manifest.load(self.read('manifest'))
+		manifest.load(self.open('manifest'))
 		return manifest
 
 	def get_extra_data(self, path):
-		"""Returns all extra data associated with given path as a dict"""
+		"""Returns all extra data associated with given path as a dict {key: file-like object}.
+		Values are streamed out of the archive as they are read, so they should be read in chunks
+		if they may be large."""
+		if path in self._in_base:
+			return self.get_base().get_extra_data(path)
+		if self.stream:
+			return self.get_stream_extra_data(path)
 		path = self.archive_path(path)
 		data = {}
-		# scan for path/KEY files
-		for name in self.get_names():
-			if os.path.dirname(name) != path:
-				continue
-			key = os.path.basename(name)
-			if not key.startswith('_'):
-				continue
-			if not self.tar.getmember(name).isfile():
+		# read in archive order, so a compressed archive is only read forwards
+		items = sorted(self._index.get(path, {}).items(), key=lambda item: item[1].offset_data)
+		for key, tarinfo in items:
+			if not tarinfo.isfile():
 				raise ValueError("Bad archive: extra data key {!r} under {!r} is not a file".format(key, path))
-			key = key[1:] # strip leading '_'
-			data[key] = self.read(name)
+			if self.is_chunked(tarinfo):
+				data[key] = self.open_chunked(tarinfo)
+			elif self.random_access and isinstance(self.tar.fileobj, file):
+				# values may be read by handlers restoring in threads, see Handler.restore_in_thread.
+				# Since the archive is a real file, values can be copied straight out of it, see FileRange.
+				data[key] = FileRange(self.tar.fileobj, tarinfo.offset_data, tarinfo.size, self.read_lock)
+			elif self.random_access:
+				data[key] = LockedReader(self.tar.extractfile(tarinfo), self.read_lock)
+			else:
+				# handlers may read keys in any order, so spool them now while we're reading forwards
+				data[key] = self.spool(self.tar.extractfile(tarinfo))
 		return data
 
-	def restore(self):
-		# XXX: Future work: Restore files in order of receipt (dependencies permitting) for better behaviour
-		# on a slow incoming stream instead of a random access file.
+	def iter_extra_data_history(self, path):
+		"""Yields the extra data for path from this archive (as per get_extra_data()), then for an incremental
+		archive, the data for path from each base archive in turn. Each base archive is only opened once
+		the previous data has been consumed. See Handler.restore_from_history()."""
+		archive = self
+		while True:
+			if path in archive._in_base:
+				# this archive uses its base's data for path, so skip straight to the base
+				archive = archive.get_base()
+				continue
+			yield archive.get_extra_data(path)
+			if not archive.is_incremental():
+				return
+			archive = archive.get_base()
+
+	def get_dependency_graph(self, manifest):
+		"""Returns the DependencyGraph of manifest (which should be this archive's manifest)
+		as stored in the archive, or for archives which don't store it, by asking the handlers."""
+		if self._depends is None:
+			return manifest.get_dependency_graph()
+		return DependencyGraph.from_overrides(manifest.files, self._depends)
+
+	def restore(self, paths=(), subtrees=()):
+		"""Restore the files in the archive. If paths or subtrees are given, only restore those paths
+		and everything under those subtrees, see Manifest.select_paths()."""
 		manifest = self.get_manifest()
-		manifest.restore_all(self)
+		graph = self._graph if self.stream else self.get_dependency_graph(manifest)
+		if paths or subtrees:
+			graph = graph.subgraph(manifest.select_paths(graph, paths, subtrees))
+			if self.stream:
+				self._stream_wanted = set(self.archive_path(path) for path in graph.depends)
+		if any(path in self._in_base for path in graph.depends):
+			# open the base now, so a missing base fails before anything is restored
+			self.get_base()
+		if not self.stream:
+			manifest.restore_all(self, graph)
+			return
+		# restore files in order of receipt (dependencies permitting) while the stream is still arriving
+		reader = gevent.spawn(self.read_stream)
+		manifest.restore_all(self, graph)
+		reader.get()
+
+	# --- stream read methods ---
+
+	def read_stream_manifest(self):
+		"""Read the manifest, which must be the first member of the stream,
+		and prepare to receive extra data in its dependency order."""
+		tarinfo = self.tar.next()
+		if tarinfo is None or tarinfo.name != 'manifest':
+			raise ValueError("Bad archive: Cannot stream archive which does not start with a manifest")
+		self._manifest = Manifest()
+		self._manifest.load(self.tar.extractfile(tarinfo))
+		# read any further metadata members, then put back the first member that isn't one
+		tarinfo = self.tar.next()
+		while tarinfo is not None and tarinfo.name in self.HEADER_MEMBERS:
+			self.read_header(tarinfo.name, self.tar.extractfile(tarinfo))
+			tarinfo = self.tar.next()
+		self._stream_next = [] if tarinfo is None else [tarinfo]
+		if self._fingerprints is None:
+			self._fingerprints = {}
+		self._index = {}
+		self._stream_error = None
+		# paths are marked as arrived in dependency order, up to and including the most recent path
+		# that we have received extra data for. Any paths before that without data have no data.
+		self._graph = self.get_dependency_graph(self._manifest)
+		self._stream_order = self._graph.order()
+		self._stream_position = 0
+		self._stream_positions = {self.archive_path(path): i for i, path in enumerate(self._stream_order)}
+		self._arrived = {path: Event() for path in self._stream_order}
+		# paths in the base archive are available immediately
+		for path in self._in_base:
+			if path in self._arrived:
+				self._arrived[path].set()
+
+	def read_stream(self):
+		"""Read extra data from the stream until it ends, spooling each path's data
+		and marking it as arrived once all its keys have been received."""
+		try:
+			current = None
+			for tarinfo in chain(self._stream_next, self.tar):
+				dirname, key = self.split_member(tarinfo.name)
+				if key is None:
+					continue
+				if dirname != current:
+					if current is not None:
+						self._mark_arrived(current)
+					current = dirname
+				if self._stream_wanted is not None and dirname not in self._stream_wanted:
+					continue
+				if tarinfo.islnk():
+					raise ValueError("Cannot stream archive containing deduplicated data, it must be read from a seekable file")
+				if not tarinfo.isfile():
+					raise ValueError("Bad archive: extra data key {!r} under {!r} is not a file".format(key, dirname))
+				if self.is_chunked(tarinfo):
+					value = self.open_chunked(tarinfo)
+				else:
+					value = self.spool(self.tar.extractfile(tarinfo))
+				self._index.setdefault(dirname, {})[key] = value
+				gevent.sleep(0) # give waiting restores a chance to run
+			if current is not None:
+				self._mark_arrived(current)
+		except Exception as ex:
+			self._stream_error = ex
+			raise
+		finally:
+			# anything not yet arrived has no data (or never will, if we failed)
+			for event in self._arrived.values():
+				event.set()
+
+	def _mark_arrived(self, dirname):
+		position = self._stream_positions.get(dirname)
+		if position is None:
+			return # not a path in the manifest
+		if position < self._stream_position:
+			raise ValueError("Bad archive: Cannot stream archive which is not in dependency order")
+		for path in self._stream_order[self._stream_position:position + 1]:
+			self._arrived[path].set()
+		self._stream_position = position + 1
+
+	def get_stream_extra_data(self, path):
+		"""As get_extra_data(), but waits for the data to arrive. Data is discarded once retrieved."""
+		if path in self._arrived:
+			self._arrived[path].wait()
+		if self._stream_error is not None:
+			raise ValueError("Stream failed before data for {!r} arrived: {}".format(path, self._stream_error))
+		return self._index.pop(self.archive_path(path), {})
 
 	# --- write methods ---
 
-	def build_tarinfo(self, path, isdir=False, size=None):
+	def build_tarinfo(self, path, isdir=False, size=None, pax_headers=None):
 		# code adpated from TarFile.gettarinfo()
 		# there seems to be no easy way to write a file without a matching "real" file to stat for info
 		tarinfo = self.tar.tarinfo()
@@ -120,20 +593,117 @@ class Archive(object):
 		tarinfo.type = DIRTYPE if isdir else REGTYPE
 		if tarinfo.size is None:
 			raise ValueError("Size is required for regular files")
+		if pax_headers:
+			tarinfo.pax_headers = dict(pax_headers)
 		return tarinfo
 
-	def write(self, path, value):
+	def addfile(self, tarinfo, fileobj=None):
+		"""Add a member to the tar file, recording where its data is for the index (see write_index()).
+		The size in tarinfo is taken before the data is copied, so files which change size in between
+		can't stop the archive being written: data beyond that size is left out, and if there's less,
+		the rest is padded with zeros. Either way, a warning is logged."""
+		if fileobj is None:
+			self.tar.addfile(tarinfo)
+		else:
+			reader = FixedSizeReader(fileobj, tarinfo.size)
+			self.tar.addfile(tarinfo, reader)
+			if reader.padded:
+				logger.warning("{} shrank by {} bytes while being archived, the rest was padded with zeros".format(
+					tarinfo.name, reader.padded,
+				))
+			elif isinstance(fileobj, file) and stream_size(fileobj):
+				logger.warning("{} grew while being archived, only the first {} bytes were stored".format(
+					tarinfo.name, tarinfo.size,
+				))
+		if self._written is not None:
+			# the data is padded to a whole number of blocks, and ends where the next member will start
+			padded_size = -(-tarinfo.size // BLOCKSIZE) * BLOCKSIZE
+			chunked = bool(tarinfo.pax_headers.get(self.CHUNKED_HEADER))
+			self._written.append((
+				tarinfo.name, tarinfo.type, self.tar.offset - padded_size, tarinfo.size, tarinfo.linkname, chunked,
+			))
+
+	def write_index(self):
+		"""Write the index member, listing where each compressed block starts and every member written so far.
+		For compressed archives, the index starts a new block so it can be read on its own.
+		Returns the trailer to write after the end of the archive, which gives the location of the index."""
+		written, self._written = self._written, None
+		index_offset = index_compressed_offset = self.tar.offset
+		blocks = []
+		if self.compressor is not None:
+			self.compressor.flush()
+			index_compressed_offset = self.compressor.compressed_offset
+			blocks = self.compressor.blocks
+		lines = chain(
+			("block\t{}\t{}\n".format(raw, compressed) for raw, compressed in blocks),
+			(
+				"member\t{}\t{}\t{}\t{}\t{}\t{}\n".format(
+					name.encode('string-escape'), type, offset_data, size, linkname.encode('string-escape'), int(chunked),
+				) for name, type, offset_data, size, linkname, chunked in written
+			),
+		)
+		fileobj, size = open_stream(lines)
+		try:
+			self.tar.addfile(self.build_tarinfo('index', size=size), fileobj)
+		finally:
+			close_stream(fileobj)
+		trailer = "{}{} {}\n".format(self.TRAILER_PREFIX, index_offset, index_compressed_offset)
+		if self.codec is not None:
+			trailer = self.codec.compress_block(trailer, self.codec.default_level)
+		return trailer
+
+	def write(self, path, value, chunked=False):
+		"""Write value to path. Value may be a string (or anything that can be converted to one),
+		a file-like object or an iterable of string chunks. See streams.open_stream() for details.
+		Streams are copied into the archive in chunks, and are closed once written.
+		If chunked=True and we have a chunk store, large values are put in the chunk store.
+		This should only be used for extra data, metadata should always be readable from the archive alone."""
 		if self._names is None:
 			self._names = set()
 		self.mkdir(os.path.dirname(path))
-		value = str(value)
 
-		pseudofile = StringIO(value)
-		tarinfo = self.build_tarinfo(path, size=len(value))
-		self.tar.addfile(tarinfo, pseudofile)
+		fileobj, size = open_stream(value)
+		pax_headers = {}
+		try:
+			if chunked and self.chunkstore is not None and size >= STORE_MIN_SIZE:
+				# put the data in the chunk store, and only write the list of chunks
+				digests = self.chunkstore.store(fileobj)
+				close_stream(fileobj)
+				fileobj, size = open_stream(''.join('{}\n'.format(digest) for digest in digests))
+				pax_headers[self.CHUNKED_HEADER] = '1'
+			if self.dedup:
+				fileobj = self.write_dedup(path, fileobj, size, pax_headers)
+			else:
+				tarinfo = self.build_tarinfo(path, size=size, pax_headers=pax_headers)
+				self.addfile(tarinfo, fileobj)
+		finally:
+			close_stream(fileobj)
 
 		self._names.add(path)
 
+	def write_dedup(self, path, fileobj, size, pax_headers=None):
+		"""Write fileobj to path, or a hard link to an identical value if one has already been written.
+		Values are hashed as they are written. We only need to hash a value before writing it
+		if we've already seen a value of the same size.
+		Returns the file object, which may have been replaced if we needed to spool it."""
+		# a chunk list should never be confused with a plain value with the same contents
+		blob_key = size, bool(pax_headers)
+		candidates = self._blobs.get(blob_key)
+		if candidates:
+			fileobj, start = make_seekable(fileobj)
+			digest = hash_stream(fileobj, size)
+			if digest in candidates:
+				tarinfo = self.build_tarinfo(path, size=0)
+				tarinfo.type = LNKTYPE
+				tarinfo.linkname = candidates[digest]
+				self.addfile(tarinfo)
+				return fileobj
+			fileobj.seek(start)
+		hasher = HashingReader(fileobj)
+		self.addfile(self.build_tarinfo(path, size=size, pax_headers=pax_headers), hasher)
+		self._blobs.setdefault(blob_key, {})[hasher.hexdigest()] = path
+		return fileobj
+
 	def mkdir(self, path):
 		"""Recursively create directories if they do not already exist"""
 		if self._names is None:
@@ -145,24 +715,85 @@ class Archive(object):
 		if path != parent: # this catches the root case
 			self.mkdir(parent)
 
-		self.tar.addfile(self.build_tarinfo(path, isdir=True))
+		self.addfile(self.build_tarinfo(path, isdir=True))
 
 		self._names.add(path)
 
 	def add_extra_data(self, path, data):
 		"""Add given data under the path for the given filepath"""
 		archive_path = self.archive_path(path)
-		for key, value in data.items():
-			if key.startswith('_'):
-				raise ValueError("Handler offered illegal key {!r} for path {!r}".format(key, path))
-			self.write(os.path.join(archive_path, '_{}'.format(key)), value)
+		try:
+			for key in data.keys():
+				if key.startswith('_'):
+					raise ValueError("Handler offered illegal key {!r} for path {!r}".format(key, path))
+				# written values are closed by write(), so only the rest are left to clean up on error
+				self.write(os.path.join(archive_path, '_{}'.format(key)), data.pop(key), chunked=True)
+		except Exception:
+			close_values(data)
+			raise
 
-	def add_manifest(self, manifest):
-		"""Add given manifest and all its contents."""
+	def add_manifest(self, manifest, base=None, base_ref=None, **collect_options):
+		"""Add given manifest and all its contents.
+		If base is given, it should be a previous archive opened for reading. An incremental archive
+		will be written, omitting data for any paths whose fingerprint matches the one in the base.
+		base_ref is the location of the base archive to record, relative to the location of this archive,
+		and defaults to base.filepath. The absolute location of base.filepath is also recorded, for readers
+		which don't know where this archive is (see get_base()).
+		Extra data is gathered concurrently ahead of writing it, see pipeline.collect_extra_data()
+		for the available options."""
 		if None in manifest.files.values():
 			raise ValueError("Cannot create archive for manifest: Contains unmatched paths")
-		self.write('manifest', manifest.dump())
-		for path, handler in manifest.files.items():
-			data = handler.get_extra_data()
+		# generators of lines are spooled as they are written, rather than being built up in memory
+		self.write('manifest', manifest.iter_dump())
+
+		fingerprints = dict(manifest.get_fingerprints())
+		self.write('fingerprints', (
+			"{}\t{}\n".format(path.encode('string-escape'), fingerprint)
+			for path, fingerprint in sorted(fingerprints.items())
+		))
+
+		in_base = set()
+		previous_fingerprints = {}
+		if base is not None:
+			if base_ref is None:
+				base_ref = base.filepath
+			if base_ref is None:
+				raise ValueError("Location of base archive must be given if it was not opened from a file")
+			if base.filepath is not None and os.path.abspath(base.filepath) != base_ref:
+				base_line = "{}\t{}".format(base_ref, os.path.abspath(base.filepath))
+			else:
+				base_line = base_ref
+			if '\t' in base_ref or '\n' in base_line:
+				raise ValueError("Location of base archive may not contain tabs or newlines: {!r}".format(base_ref))
+			base_fingerprints = base.get_fingerprints()
+			for path, fingerprint in fingerprints.items():
+				base_fingerprint = base_fingerprints.get(path)
+				if base_fingerprint is None:
+					continue
+				if base_fingerprint == fingerprint:
+					in_base.add(path)
+					continue
+				# handlers may store only the changes since the base, if the base used the same handler and args.
+				# See Handler.get_incremental_extra_data().
+				name, argstr, previous = base_fingerprint.split('\t', 2)
+				if fingerprint.split('\t', 2)[:2] == [name, argstr]:
+					previous_fingerprints[path] = previous
+			self.write('base', chain(
+				["{}\n".format(base_line)],
+				("{}\n".format(path.encode('string-escape')) for path in sorted(in_base)),
+			))
+
+		if self.chunkstore is not None:
+			self.write('chunkstore', os.path.abspath(self.chunkstore.path))
+
+		graph = manifest.get_dependency_graph()
+		self.write('depends', (
+			"{}\n".format("\t".join(part.encode('string-escape') for part in [path] + dependencies))
+			for path, dependencies in sorted(graph.get_overrides().items())
+		))
+
+		paths = [path for path in graph.order() if path not in in_base]
+		for path, data in collect_extra_data(manifest, paths, previous_fingerprints=previous_fingerprints,
+		                                     **collect_options):
 			if data:
 				self.add_extra_data(path, data)
@@ -0,0 +1,143 @@
+
+import hashlib
+import os
+import struct
+import tempfile
+
+from streams import ChunkStream
+
+# optional C implementation of find_cut(), built by setup.py if a compiler is available
+try:
+	import _gear
+except ImportError:
+	_gear = None
+
+
+# Chunk boundaries are placed wherever the rolling hash has its top CHUNK_AVG_BITS bits all zero,
+# giving an average chunk size of 2**CHUNK_AVG_BITS, subject to these limits.
+CHUNK_MIN = 16 * 1024
+CHUNK_AVG_BITS = 16
+CHUNK_MAX = 256 * 1024
+# values smaller than this aren't worth splitting, and are stored in the archive directly
+STORE_MIN_SIZE = 64 * 1024
+
+_MASK64 = (1 << 64) - 1
+_CUT_MASK = ((1 << CHUNK_AVG_BITS) - 1) << (64 - CHUNK_AVG_BITS)
+# Gear hash lookup table. This must never change, or chunk boundaries (and so deduplication)
+# will differ from existing stores. It's derived from sha256 rather than random so it's stable.
+_GEAR = [struct.unpack('<Q', hashlib.sha256(chr(i)).digest()[:8])[0] for i in range(256)]
+# the same table, packed for the C implementation
+_GEAR_TABLE = struct.pack('=256Q', *_GEAR)
+
+
+def find_cut(data):
+	"""Returns the length of the first content-defined chunk in data (a bytearray).
+	We use a Gear rolling hash, where each bit of the hash only depends on the last 64 bytes.
+	No boundary is placed before CHUNK_MIN, so we don't need to hash those bytes at all."""
+	end = min(len(data), CHUNK_MAX)
+	if end <= CHUNK_MIN:
+		return end
+	if _gear is not None:
+		return _gear.find_cut(data, CHUNK_MIN, end, _GEAR_TABLE, _CUT_MASK)
+	# this is slow (a few MB/s), so is only a fallback for when the C version isn't built
+	gear = _GEAR
+	h = 0
+	for i in xrange(CHUNK_MIN, end):
+		h = ((h << 1) + gear[data[i]]) & _MASK64
+		if not h & _CUT_MASK:
+			return i + 1
+	return end
+
+
+def split_chunks(fileobj):
+	"""Read fileobj to EOF, yielding it as a series of content-defined chunks.
+	Since chunk boundaries depend only on the nearby content, an insertion or deletion
+	only changes the chunks around it, and the rest will still deduplicate against earlier versions."""
+	data = bytearray()
+	eof = False
+	while True:
+		while not eof and len(data) < CHUNK_MAX:
+			block = fileobj.read(CHUNK_MAX)
+			if block:
+				data.extend(block)
+			else:
+				eof = True
+		if not data:
+			return
+		cut = find_cut(data)
+		yield str(data[:cut])
+		del data[:cut]
+
+
+class ChunkStore(object):
+	"""A chunk store is a directory of content-defined chunks, keyed by their sha256 hash.
+	Archives using a chunk store only contain the list of chunks for large values, so chunks
+	are shared between all archives using the same store.
+	Since the store doesn't know which archives exist, removing unreferenced chunks must be done
+	explicitly, given the list of archives still in use. See gc().
+	"""
+
+	def __init__(self, path):
+		self.path = path
+
+	def chunk_path(self, digest):
+		return os.path.join(self.path, digest[:2], digest)
+
+	def store(self, fileobj):
+		"""Store the contents of fileobj, returning the list of chunk hashes that make it up."""
+		digests = []
+		for chunk in split_chunks(fileobj):
+			digest = hashlib.sha256(chunk).hexdigest()
+			path = self.chunk_path(digest)
+			if not os.path.exists(path):
+				self.write_chunk(path, chunk)
+			digests.append(digest)
+		return digests
+
+	def write_chunk(self, path, chunk):
+		# write to a temp file and rename it into place, so a chunk that exists is always complete
+		dirname = os.path.dirname(path)
+		if not os.path.isdir(dirname):
+			try:
+				os.makedirs(dirname)
+			except OSError:
+				if not os.path.isdir(dirname):
+					raise
+		fd, temp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write(chunk)
+			os.rename(temp_path, path)
+		except Exception:
+			os.remove(temp_path)
+			raise
+
+	def read_chunk(self, digest):
+		with open(self.chunk_path(digest), 'rb') as f:
+			chunk = f.read()
+		if hashlib.sha256(chunk).hexdigest() != digest:
+			raise ValueError("Chunk store is corrupt: Chunk {} does not match its hash".format(digest))
+		return chunk
+
+	def open(self, digests):
+		"""Returns a file-like object which reads the data made up of the given chunks."""
+		return ChunkStream(self.read_chunk(digest) for digest in digests)
+
+	def list_chunks(self):
+		"""Yields the hashes of all chunks in the store"""
+		for prefix in os.listdir(self.path):
+			dirname = os.path.join(self.path, prefix)
+			if len(prefix) != 2 or not os.path.isdir(dirname):
+				continue
+			for name in os.listdir(dirname):
+				if not name.startswith('.'):
+					yield name
+
+	def gc(self, referenced):
+		"""Remove all chunks whose hash is not in referenced. Returns the number of chunks removed."""
+		removed = 0
+		for digest in list(self.list_chunks()):
+			if digest not in referenced:
+				os.remove(self.chunk_path(digest))
+				removed += 1
+		return removed
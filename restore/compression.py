@@ -0,0 +1,376 @@
+
+import bz2
+import multiprocessing
+import os
+import zlib
+from bisect import bisect_right
+from collections import deque
+
+from gevent.threadpool import ThreadPool
+
+from streams import CHUNK_SIZE
+
+# optional dependencies for extra codecs
+try:
+	import zstandard
+except ImportError:
+	zstandard = None
+try:
+	import lz4.frame
+except ImportError:
+	lz4 = None
+
+
+# Max number of threads to use for compression. May be overridden by env var of the same name.
+COMPRESS_THREADS_MAX = int(os.environ.get('COMPRESS_THREADS_MAX', multiprocessing.cpu_count()))
+# Size of the independently compressed blocks, for codecs that compress in parallel blocks
+COMPRESS_BLOCK_SIZE = 1024 * 1024
+
+
+class Codec(object):
+	"""A compression format. Codecs are looked up by name with get_codec(),
+	and detected when reading by the magic bytes at the start of the data.
+	By default, codecs compress data in independent blocks across multiple threads
+	(see ParallelBlockWriter), concatenating the resulting frames. This relies on the format's
+	decompressors accepting concatenated frames, as gzip, bzip2 and lz4 tools all do.
+	"""
+	name = NotImplemented
+	magic = NotImplemented
+	default_level = None
+
+	def check_available(self):
+		"""Raise if this codec can't be used, eg. due to a missing optional dependency"""
+		pass
+
+	def compress_block(self, data, level):
+		"""Compress data into a complete, standalone frame. Called from a worker thread."""
+		raise NotImplementedError
+
+	def decompressor(self):
+		"""Return a new decompressor object for one frame, with a decompress(data) method"""
+		raise NotImplementedError
+
+	def unused_data(self, decompressor):
+		"""Return any data given to decompressor after the end of its frame, which should
+		be passed to a new decompressor."""
+		return decompressor.unused_data
+
+	def open_writer(self, fileobj, level=None, threads=None):
+		"""Return a write-only file-like object which compresses data written to it into fileobj.
+		Closing it finishes the compressed data, but does not close fileobj."""
+		self.check_available()
+		if level is None:
+			level = self.default_level
+		return ParallelBlockWriter(fileobj, lambda block: self.compress_block(block, level), threads)
+
+
+class GzipCodec(Codec):
+	name = 'gz'
+	magic = '\x1f\x8b'
+	default_level = 6
+
+	def compress_block(self, data, level):
+		# wbits=31 selects the gzip container format
+		compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+		return compressor.compress(data) + compressor.flush()
+
+	def decompressor(self):
+		return zlib.decompressobj(31)
+
+
+class Bzip2Codec(Codec):
+	name = 'bz2'
+	magic = 'BZh'
+	default_level = 9
+
+	def compress_block(self, data, level):
+		return bz2.compress(data, level)
+
+	def decompressor(self):
+		return bz2.BZ2Decompressor()
+
+
+class LZ4Codec(Codec):
+	name = 'lz4'
+	magic = '\x04\x22\x4d\x18'
+	default_level = 0
+
+	def check_available(self):
+		if lz4 is None:
+			raise ValueError("lz4 compression requires the lz4 package")
+
+	def compress_block(self, data, level):
+		return lz4.frame.compress(data, compression_level=level)
+
+	def decompressor(self):
+		self.check_available()
+		return lz4.frame.LZ4FrameDecompressor()
+
+
+class ZstdCodec(Codec):
+	"""zstd supports multi-threaded compression natively, so we use that instead of parallel blocks,
+	producing a single frame."""
+	name = 'zstd'
+	magic = '\x28\xb5\x2f\xfd'
+	default_level = 3
+
+	def check_available(self):
+		if zstandard is None:
+			raise ValueError("zstd compression requires the zstandard package")
+
+	def open_writer(self, fileobj, level=None, threads=None):
+		self.check_available()
+		if level is None:
+			level = self.default_level
+		if threads is None:
+			threads = COMPRESS_THREADS_MAX
+		compressor = zstandard.ZstdCompressor(level=level, threads=threads)
+		return ZstdWriter(compressor.stream_writer(fileobj))
+
+	def decompressor(self):
+		self.check_available()
+		return zstandard.ZstdDecompressor().decompressobj()
+
+	def unused_data(self, decompressor):
+		return '' # we only ever write a single frame
+
+
+class ZstdWriter(object):
+	def __init__(self, writer):
+		self.writer = writer
+
+	def write(self, data):
+		self.writer.write(data)
+
+	def close(self):
+		# end the frame without closing the underlying file
+		self.writer.flush(zstandard.FLUSH_FRAME)
+
+
+CODECS = {codec.name: codec for codec in (GzipCodec(), Bzip2Codec(), LZ4Codec(), ZstdCodec())}
+
+
+def get_codec(name):
+	if name not in CODECS:
+		raise ValueError("Unknown compression {!r}, must be one of: {}".format(name, ", ".join(sorted(CODECS))))
+	return CODECS[name]
+
+
+class ParallelBlockWriter(object):
+	"""Write-only file-like object which splits data into fixed-size blocks, compresses each one
+	independently in a thread pool, and writes the results to fileobj in order.
+	Compression libraries release the GIL, so this uses multiple cores.
+	Since each block can be decompressed on its own, readers can seek by starting from the nearest block.
+	blocks lists (uncompressed offset, compressed offset) for the start of each block written so far.
+	"""
+
+	def __init__(self, fileobj, compress_block, threads=None, block_size=COMPRESS_BLOCK_SIZE):
+		if threads is None:
+			threads = COMPRESS_THREADS_MAX
+		self.fileobj = fileobj
+		self.compress_block = compress_block
+		self.block_size = block_size
+		self.pool = ThreadPool(threads)
+		# limit the number of blocks in flight, to bound memory use
+		self.max_pending = 2 * threads
+		self.pending = deque() # (uncompressed size, result) for each block in flight
+		self.buffer = []
+		self.buffered = 0
+		self.position = 0 # total uncompressed bytes written to us
+		self.blocks = []
+		self.raw_offset = 0 # uncompressed bytes written out so far
+		self.compressed_offset = 0 # compressed bytes written out so far
+
+	def write(self, data):
+		self.buffer.append(data)
+		self.buffered += len(data)
+		self.position += len(data)
+		if self.buffered >= self.block_size:
+			data = ''.join(self.buffer)
+			while len(data) >= self.block_size:
+				self._submit(data[:self.block_size])
+				data = data[self.block_size:]
+			self.buffer = [data]
+			self.buffered = len(data)
+
+	def tell(self):
+		return self.position
+
+	def _submit(self, block):
+		self.pending.append((len(block), self.pool.spawn(self.compress_block, block)))
+		while len(self.pending) > self.max_pending:
+			self._write_pending()
+
+	def _write_pending(self):
+		size, result = self.pending.popleft()
+		data = result.get()
+		self.fileobj.write(data)
+		self.blocks.append((self.raw_offset, self.compressed_offset))
+		self.raw_offset += size
+		self.compressed_offset += len(data)
+
+	def flush(self):
+		"""End the current block early and write out all blocks, so the next data written starts a new block
+		at (raw_offset, compressed_offset)."""
+		data = ''.join(self.buffer)
+		self.buffer = []
+		self.buffered = 0
+		if data:
+			self._submit(data)
+		while self.pending:
+			self._write_pending()
+
+	def close(self):
+		self.flush()
+		self.pool.kill()
+
+
+class DecompressingReader(object):
+	"""Read-only file-like object which decompresses a series of concatenated frames from fileobj.
+	Like gzip.GzipFile, it supports seeking, but seeking backwards means decompressing again
+	from the start, and requires fileobj to be seekable.
+	If the offsets at which frames start are known (see set_blocks()), seeking instead starts
+	decompressing from the nearest frame.
+	"""
+
+	def __init__(self, fileobj, codec):
+		self.fileobj = fileobj
+		self.codec = codec
+		try:
+			self.start = fileobj.tell()
+		except (AttributeError, IOError):
+			self.start = None
+		self.blocks = []
+		self.block_starts = []
+		self._reset()
+
+	def set_blocks(self, blocks):
+		"""Give a sorted list of (uncompressed offset, compressed offset) where frames start,
+		as per ParallelBlockWriter.blocks. Compressed offsets are relative to where the data starts in fileobj."""
+		self.blocks = blocks
+		self.block_starts = [raw for raw, compressed in blocks]
+
+	def _reset(self):
+		self.decompressor = self.codec.decompressor()
+		# decompressed data not yet read is buffer[buffer_offset:]. Keeping an offset means small reads
+		# don't need to copy the rest of the buffer, which may be large for very compressible data.
+		self.buffer = ''
+		self.buffer_offset = 0
+		self.position = 0
+		self.eof = False
+
+	def _decompress(self, data):
+		output = []
+		while data:
+			if getattr(self.decompressor, 'eof', False):
+				# the last frame ended exactly at the end of the previous data, so there was no unused data
+				# to tell us, but the finished decompressor won't accept any more
+				self.decompressor = self.codec.decompressor()
+			try:
+				output.append(self.decompressor.decompress(data))
+			except EOFError:
+				# as above, for decompressors that don't have an eof attribute (eg. python 2's bz2)
+				self.decompressor = self.codec.decompressor()
+				continue
+			data = self.codec.unused_data(self.decompressor)
+			if data:
+				# end of frame, start the next one
+				self.decompressor = self.codec.decompressor()
+		return ''.join(output)
+
+	def read(self, size=-1):
+		if size is None or size < 0:
+			size = None
+		if size is not None and len(self.buffer) - self.buffer_offset >= size:
+			data = self.buffer[self.buffer_offset:self.buffer_offset + size]
+			self.buffer_offset += size
+			self.position += size
+			return data
+		parts = [self.buffer[self.buffer_offset:]]
+		length = len(parts[0])
+		while not self.eof and (size is None or length < size):
+			data = self.fileobj.read(CHUNK_SIZE)
+			if not data:
+				self.eof = True
+				break
+			data = self._decompress(data)
+			parts.append(data)
+			length += len(data)
+		data = ''.join(parts)
+		if size is None or size >= len(data):
+			self.buffer = ''
+			self.buffer_offset = 0
+		else:
+			self.buffer = data
+			self.buffer_offset = size
+			data = data[:size]
+		self.position += len(data)
+		return data
+
+	def tell(self):
+		return self.position
+
+	def seek(self, offset, whence=0):
+		if whence == 1:
+			offset += self.position
+		elif whence != 0:
+			raise IOError("Seeking relative to the end of compressed data is not supported")
+		index = bisect_right(self.block_starts, offset) - 1
+		if index >= 0 and self.start is not None:
+			raw, compressed = self.blocks[index]
+			# jump to the nearest frame, unless we're already in it and before offset
+			if raw > self.position or offset < self.position:
+				self.fileobj.seek(self.start + compressed)
+				self._reset()
+				self.position = raw
+		if offset < self.position:
+			if self.start is None:
+				raise IOError("Cannot seek backwards in non-seekable compressed data")
+			self.fileobj.seek(self.start)
+			self._reset()
+		while self.position < offset:
+			if not self.read(min(CHUNK_SIZE, offset - self.position)):
+				break
+
+	def close(self):
+		pass
+
+
+class PrefixedReader(object):
+	"""Read-only file-like object which returns prefix, then the rest of fileobj.
+	Used to put back data that was read to check for magic bytes from a non-seekable file."""
+
+	def __init__(self, prefix, fileobj):
+		self.prefix = prefix
+		self.fileobj = fileobj
+
+	def read(self, size=-1):
+		if not self.prefix:
+			return self.fileobj.read(size)
+		if size is None or size < 0:
+			data, self.prefix = self.prefix + self.fileobj.read(), ''
+			return data
+		data, self.prefix = self.prefix[:size], self.prefix[size:]
+		if len(data) < size:
+			data += self.fileobj.read(size - len(data))
+		return data
+
+
+def open_reader(fileobj):
+	"""Detect the compression of fileobj from its first few bytes, and return a file-like object which
+	reads the decompressed data, or fileobj itself (or an equivalent) if it isn't compressed.
+	Returns (codec, reader), where codec is None for uncompressed data."""
+	peek_size = max(len(codec.magic) for codec in CODECS.values())
+	try:
+		start = fileobj.tell()
+	except (AttributeError, IOError):
+		start = None
+	prefix = fileobj.read(peek_size)
+	if start is None:
+		fileobj = PrefixedReader(prefix, fileobj)
+	else:
+		fileobj.seek(start)
+	for codec in CODECS.values():
+		if prefix.startswith(codec.magic):
+			return codec, DecompressingReader(fileobj, codec)
+	return None, fileobj
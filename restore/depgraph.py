@@ -0,0 +1,212 @@
+
+import os
+from collections import deque
+
+
+def parent_path(path):
+	"""Returns the normalised parent directory of a manifest path, or None for the root ('.' or '/')."""
+	if path in ('.', '/'):
+		return None
+	return os.path.normpath(os.path.dirname(path))
+
+
+def default_depends(path, paths):
+	"""Returns the dependencies path has if its handler doesn't add any (see Handler.get_depends()),
+	ie. its parent directory if that's in paths."""
+	parent = parent_path(path)
+	return [parent] if parent is not None and parent in paths else []
+
+
+class DependencyGraph(object):
+	"""The dependencies between the paths of a manifest. This is built once, so that ordering paths
+	and checking for cycles doesn't need to ask every handler for its dependencies each time.
+	depends maps each path to a sorted list of the paths it depends on, all of which are also in the graph.
+	All operations take time linear in the size of the graph, and don't recurse, so deep trees
+	don't hit the recursion limit.
+	"""
+
+	def __init__(self, depends):
+		self.depends = depends
+		self._order = None
+
+	@classmethod
+	def from_manifest(cls, manifest):
+		return cls({path: manifest.get_depends(path) for path in manifest.files})
+
+	@classmethod
+	def from_overrides(cls, paths, overrides):
+		"""Build a graph where each path has its default_depends(), except for those in overrides,
+		which maps paths to their actual dependencies. See get_overrides()."""
+		paths = set(paths)
+		depends = {path: default_depends(path, paths) for path in paths}
+		for path, dependencies in overrides.items():
+			if path in depends:
+				depends[path] = sorted(dependency for dependency in dependencies if dependency in paths)
+		return cls(depends)
+
+	def get_overrides(self):
+		"""Returns {path: dependencies} for paths whose dependencies aren't their default_depends().
+		This is usually far smaller than the whole graph, and is enough to rebuild it with from_overrides()."""
+		paths = self.depends.viewkeys()
+		return {
+			path: dependencies for path, dependencies in self.depends.items()
+			if dependencies != default_depends(path, paths)
+		}
+
+	def order(self):
+		"""Returns a list of all paths, such that each path comes after its dependencies.
+		Paths are visited depth-first, starting from each path in sorted order, so the order is deterministic
+		for a given graph, and archive writers and stream readers agree on it.
+		Cycles are not detected here (see check_cycles()), they simply result in some valid order
+		for the paths not involved in the cycle.
+		"""
+		if self._order is not None:
+			return self._order
+		order = []
+		visited = set()
+		for root in sorted(self.depends):
+			if root in visited:
+				continue
+			visited.add(root)
+			# depth-first search, using an explicit stack to avoid recursion limits on deep trees
+			stack = [(root, iter(self.depends[root]))]
+			while stack:
+				path, depends = stack[-1]
+				for dependency in depends:
+					if dependency not in visited:
+						visited.add(dependency)
+						stack.append((dependency, iter(self.depends[dependency])))
+						break
+				else:
+					stack.pop()
+					order.append(path)
+		self._order = order
+		return order
+
+	def subgraph(self, paths):
+		"""Returns the graph of only the given paths, ignoring their dependencies on any other paths.
+		Its order() is the same as this graph's, less the other paths."""
+		paths = set(paths)
+		graph = DependencyGraph({
+			path: [dependency for dependency in self.depends[path] if dependency in paths]
+			for path in paths
+		})
+		graph._order = [path for path in self.order() if path in paths]
+		return graph
+
+	def levels(self):
+		"""Returns {path: level}, where paths with no dependencies are at level 0, and other paths are
+		one level above their highest dependency. Paths on the same level never depend on each other.
+		Raises ValueError if there are cycles."""
+		self.check_cycles()
+		levels = {}
+		for path in self.order():
+			depends = self.depends[path]
+			levels[path] = 1 + max(levels[dependency] for dependency in depends) if depends else 0
+		return levels
+
+	def find_cycles(self):
+		"""Returns a list of every dependency cycle, in sorted order. Each cycle is a list of paths
+		like [a, b, c, a], where each path depends on the next.
+		Cycles are found as the strongly connected components of the graph (using Tarjan's algorithm),
+		and one cycle is reported for each component, even if it contains several.
+		"""
+		cycles = []
+		index = {} # {path: order in which it was first visited}
+		lowlink = {} # {path: lowest index reachable from path, among paths on the stack}
+		stack = [] # paths whose component isn't known yet
+		on_stack = set()
+		for root in sorted(self.depends):
+			if root in index:
+				continue
+			index[root] = lowlink[root] = len(index)
+			stack.append(root)
+			on_stack.add(root)
+			work = [(root, iter(self.depends[root]))]
+			while work:
+				path, depends = work[-1]
+				for dependency in depends:
+					if dependency not in index:
+						index[dependency] = lowlink[dependency] = len(index)
+						stack.append(dependency)
+						on_stack.add(dependency)
+						work.append((dependency, iter(self.depends[dependency])))
+						break
+					if dependency in on_stack:
+						lowlink[path] = min(lowlink[path], index[dependency])
+				else:
+					work.pop()
+					if work:
+						parent = work[-1][0]
+						lowlink[parent] = min(lowlink[parent], lowlink[path])
+					if lowlink[path] != index[path]:
+						continue
+					# path is the root of a component, made up of everything above it on the stack
+					component = []
+					while True:
+						member = stack.pop()
+						on_stack.remove(member)
+						component.append(member)
+						if member == path:
+							break
+					if len(component) > 1 or path in self.depends[path]:
+						cycles.append(self._find_cycle(min(component), set(component)))
+		return sorted(cycles)
+
+	def _find_cycle(self, start, component):
+		"""Returns the shortest cycle from start back to itself, through paths in component"""
+		previous = {start: None}
+		queue = deque([start])
+		while queue:
+			path = queue.popleft()
+			for dependency in self.depends[path]:
+				if dependency == start:
+					cycle = [start]
+					while path is not None:
+						cycle.append(path)
+						path = previous[path]
+					return cycle[::-1]
+				if dependency in component and dependency not in previous:
+					previous[dependency] = path
+					queue.append(dependency)
+		raise AssertionError("No cycle from {!r} within its component".format(start))
+
+	def check_cycles(self):
+		"""Raises ValueError listing every dependency cycle, if there are any."""
+		cycles = self.find_cycles()
+		if cycles:
+			raise ValueError("\n".join(
+				"Dependency cycle: {}".format(" -> ".join(map(repr, cycle)))
+				for cycle in cycles
+			))
+
+	def get_batch_depends(self, paths):
+		"""Returns the dependencies of a batch of paths (see Handler.restore_batch()), other than each other."""
+		batch = set(paths)
+		return sorted(set(
+			dependency for path in paths for dependency in self.depends[path]
+			if dependency not in batch
+		))
+
+	def check_batch_cycles(self, paths):
+		"""Check that none of the dependencies of a batch of paths depend on a path in the batch,
+		since the batch as a whole must wait for them."""
+		batch = set(paths)
+		previous = {} # {path: the path which depends on it that we found it from, or None}
+		stack = []
+		for dependency in self.get_batch_depends(paths):
+			previous[dependency] = None
+			stack.append(dependency)
+		while stack:
+			path = stack.pop()
+			if path in batch:
+				chain = []
+				while path is not None:
+					chain.append(path)
+					path = previous[path]
+				chain_text = " -> ".join(map(repr, reversed(chain)))
+				raise ValueError("Dependency cycle through restore batch: {}".format(chain_text))
+			for dependency in self.depends[path]:
+				if dependency not in previous:
+					previous[dependency] = path
+					stack.append(dependency)
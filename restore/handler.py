@@ -1,12 +1,31 @@
 
 import logging
 import os
-import pwd
-import grp
 import weakref
 from stat import S_IMODE
 
-from classtricks import get_all_subclasses, classproperty
+from classtricks import get_all_subclasses
+
+
+class FileLoggerAdapter(logging.LoggerAdapter):
+	"""Prefixes log messages with the file they concern."""
+
+	def process(self, msg, kwargs):
+		return "{!r}: {}".format(self.extra['filepath'], msg), kwargs
+
+
+class HandlerLogger(object):
+	"""Descriptor for Handler.logger. On the class, this is the logger shared by all handlers of that class.
+	On an instance, it's an adapter for that logger which includes the handler's filepath.
+	Unlike a child logger per file, adapters aren't kept forever by the logging module,
+	and are only created when something is actually logged.
+	"""
+
+	def __get__(self, instance, cls):
+		logger = logging.getLogger('restore.handlers').getChild(cls.__name__)
+		if instance is None:
+			return logger
+		return FileLoggerAdapter(logger, {'filepath': instance.filepath})
 
 
 class Handler(object):
@@ -29,13 +48,34 @@ class Handler(object):
 	"""
 
 	name = NotImplemented
+	# set to True if get_extra_data() does blocking (non-gevent) I/O, so it should be run in a thread
+	# when archiving. Handlers that use gevent, eg. for subprocesses, should leave this False.
+	collect_in_thread = False
+	# set to True if restore() only does blocking (non-gevent) I/O, so it should be run in a thread
+	# when restoring. See restore_from_history() for what such handlers may do.
+	restore_in_thread = False
+	# set to True if only one file with this handler may be restored at a time
+	serial_restore = False
+	# set to True if all files with this handler should be restored together by restore_batch(),
+	# eg. so a package manager can install every package in one transaction.
+	batch_restore = False
+
+	logger = HandlerLogger()
+
+	# cache of (cls, name) to handler class for from_name(), which is called for every line of a manifest
+	_from_name_cache = {}
 
 	@classmethod
 	def from_name(cls, name):
-		for subcls in cls.get_all():
-			if subcls.name == name:
-				return subcls
-		raise KeyError(name)
+		key = cls, name
+		if key not in Handler._from_name_cache:
+			for subcls in cls.get_all():
+				if subcls.name == name:
+					Handler._from_name_cache[key] = subcls
+					break
+			else:
+				raise KeyError(name)
+		return Handler._from_name_cache[key]
 
 	@classmethod
 	def get_all(cls):
@@ -50,12 +90,7 @@ class Handler(object):
 		"""
 		return None
 
-	@classproperty
-	def logger(cls):
-		return logging.getLogger('restore.handlers').getChild(cls.__name__)
-
 	def __init__(self, manifest, filepath):
-		self.logger = self.logger.getChild(repr(filepath))
 		self.filepath = filepath
 		# we use a weakref for manifest to break the circular reference, and handlers shouldn't be
 		# called once the manifest object is dead anyway.
@@ -73,9 +108,28 @@ class Handler(object):
 		Unlike args, which often describe WHAT needs saving, this is the part that acually saves the big data,
 		whole files, etc.
 		Returned data should be a dict {key: data}.
+		Values may be strings, or for large data, file-like objects or iterables of string chunks,
+		which will be streamed into the archive rather than held in memory. See streams.open_stream().
 		"""
 		return {}
 
+	def get_incremental_extra_data(self, previous_fingerprint):
+		"""As get_extra_data(), but called when writing an incremental archive where this file has changed
+		since the base archive. previous_fingerprint is this handler's fingerprint for the file in the base archive.
+		Handlers may use this to only store what has changed, in which case they should also override
+		restore_from_history() to combine the data from each archive.
+		Defaults to get_extra_data().
+		"""
+		return self.get_extra_data()
+
+	def get_fingerprint(self):
+		"""Return a string which will change whenever the extra data for this file changes,
+		or None if that can't be determined cheaply. Incremental archives use this to avoid storing
+		the extra data again if the file is unchanged.
+		Defaults to None, ie. always store the extra data.
+		"""
+		return None
+
 	def get_depends(self):
 		"""Return a set of paths that must be fully restored before this restore action can occur.
 		Don't forget to include super()'s results too.
@@ -87,39 +141,76 @@ class Handler(object):
 		return {os.path.dirname(self.filepath)}
 
 	def restore(self, extra_data):
-		"""Restore the target file from given saved data."""
+		"""Restore the target file from given saved data.
+		extra_data is a dict {key: file-like object}, with the same keys as returned by get_extra_data().
+		"""
 		raise NotImplementedError
 
+	def restore_from_history(self, history):
+		"""Restore the target file, given an iterator which yields this file's extra data from the archive
+		being restored, followed by the extra data from each earlier archive (for incremental archives),
+		as far back as needed. Base archives are only read if the handler asks for their data.
+		Handlers that only store changes (see get_incremental_extra_data()) should override this.
+		If restore_in_thread is set, this is called in a thread with the first extra data already retrieved,
+		so such handlers shouldn't read any further history.
+		Defaults to restore() with the most recent extra data.
+		"""
+		self.restore(next(history))
+
+	@classmethod
+	def restore_batch(cls, handlers, archive):
+		"""For handlers with batch_restore set, this is called instead of restore_from_history() to restore
+		every file in the manifest with this handler class at once. handlers is a list of handler objects
+		for those files, and archive may be used to get their extra data (see Archive.iter_extra_data_history()).
+		It's called once the dependencies of all those files are restored, other than on each other.
+		Defaults to restoring each file in turn.
+		"""
+		for handler in handlers:
+			handler.restore_from_history(archive.iter_extra_data_history(handler.filepath))
+
 
 class SavesFileInfo(Handler):
 	"""A handler which automatically takes care of file mode and ownership.
 	Remember to call super() for get_extra_data() and restore().
 	Owner and group are saved by name, not by id, since this is likely to be incorrect across machines.
 	If no user exists for a file's UID, the file's owner is not saved.
+	Likewise if no user exists with the saved name on restore, the owner is left unchanged.
+	Names are resolved through the manifest's owner_cache, see OwnerCache.
 	"""
 
+	collect_in_thread = True
+	restore_in_thread = True
+
 	def get_extra_data(self):
-		stat = os.stat(self.filepath)
-		try:
-			owner = pwd.getpwuid(stat.st_uid).pw_name
-		except KeyError:
-			owner = None
-		try:
-			group = grp.getgrgid(stat.st_gid).gr_name
-		except KeyError:
-			group = None
+		# if the cache has no result, call os.stat() anyway to raise the appropriate error
+		stat = self.manifest.stat_cache.stat(self.filepath) or os.stat(self.filepath)
+		owner_cache = self.manifest.owner_cache
 		return {
 			'mode': S_IMODE(stat.st_mode),
-			'owner': owner,
-			'group': group,
+			'owner': owner_cache.user_name(stat.st_uid),
+			'group': owner_cache.group_name(stat.st_gid),
 		}
 
+	def get_fingerprint(self):
+		# ctime covers changes to mode and ownership, as well as content
+		stat = self.manifest.stat_cache.lstat(self.filepath)
+		if stat is None:
+			return None
+		return "{} {!r} {!r} {}".format(stat.st_size, stat.st_mtime, stat.st_ctime, stat.st_ino)
+
 	def restore(self, extra_data):
 		stat = os.stat(self.filepath)
-		mode = int(extra_data['mode'])
+		mode = int(extra_data['mode'].read())
 		if S_IMODE(stat.st_mode) != mode:
 			os.chmod(self.filepath, mode)
-		uid = stat.st_uid if extra_data['owner'] is None else pwd.getpwnam(extra_data['owner']).pw_uid
-		gid = stat.st_gid if extra_data['group'] is None else grp.getgrnam(extra_data['group']).gr_gid
+		owner = extra_data['owner'].read()
+		group = extra_data['group'].read()
+		owner_cache = self.manifest.owner_cache
+		uid = owner_cache.uid(owner)
+		gid = owner_cache.gid(group)
+		if uid is None:
+			uid = stat.st_uid
+		if gid is None:
+			gid = stat.st_gid
 		if uid != stat.st_uid or gid != stat.st_gid:
 			os.chown(self.filepath, uid, gid)
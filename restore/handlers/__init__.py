@@ -19,6 +19,7 @@ LAST_HANDLERS = [
 
 _DEFAULT_HANDLERS = [
 	packages.PacmanHandler,
+	packages.DpkgHandler,
 	ignore.IgnoreHandler,
 	git.GitCloneHandler,
 	git.GitBundleHandler,
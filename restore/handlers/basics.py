@@ -1,7 +1,9 @@
 
 import os
+import tempfile
 
 from restore.handler import SavesFileInfo, Handler
+from restore.streams import ExtentReader, copy_stream, find_extents
 
 
 class BasicDirectoryHandler(SavesFileInfo):
@@ -12,7 +14,7 @@ class BasicDirectoryHandler(SavesFileInfo):
 	@classmethod
 	def match(cls, manifest, filepath):
 		# match all directories
-		if os.path.isdir(filepath):
+		if manifest.stat_cache.isdir(filepath):
 			return (), {}
 
 	def restore(self, extra_data):
@@ -22,27 +24,65 @@ class BasicDirectoryHandler(SavesFileInfo):
 
 
 class BasicFileHandler(SavesFileInfo):
-	"""Fallback default handler for files - saves entire file contents as data"""
+	"""Fallback default handler for files - saves entire file contents as data.
+	For sparse files, only the parts containing data are saved, along with a list of where they go
+	(see streams.find_extents()), and the holes are re-created on restore.
+	Files are restored to a temporary file next to them, which is then renamed into place.
+	"""
 
 	name = 'basic-file'
 
 	@classmethod
 	def match(cls, manifest, filepath):
 		# match all regular files
-		if os.path.isfile(filepath):
+		if manifest.stat_cache.isfile(filepath):
 			return (), {}
 
 	def get_extra_data(self):
 		extra_data = super(BasicFileHandler, self).get_extra_data()
-		with open(self.filepath) as f:
-			extra_data['content'] = f.read()
+		# the archive streams the content from the open file, and closes it when done
+		content = open(self.filepath, 'rb')
+		try:
+			extents = find_extents(content)
+		except Exception:
+			content.close()
+			raise
+		if extents is None:
+			extra_data['content'] = content
+			return extra_data
+		extra_data['content'] = ExtentReader(content, extents)
+		# the file's size, then the offset and length of each extent
+		extra_data['extents'] = "{}\n{}".format(
+			os.fstat(content.fileno()).st_size,
+			"".join("{} {}\n".format(offset, length) for offset, length in extents),
+		)
 		return extra_data
 
 	def restore(self, extra_data):
-		with open(self.filepath, 'w') as f:
-			f.write(extra_data['content'])
+		dirname, filename = os.path.split(self.filepath)
+		fd, temp_path = tempfile.mkstemp(dir=dirname or '.', prefix='.{}.'.format(filename))
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				self.write_content(extra_data, f)
+			os.rename(temp_path, self.filepath)
+		except Exception:
+			os.remove(temp_path)
+			raise
 		super(BasicFileHandler, self).restore(extra_data)
 
+	def write_content(self, extra_data, f):
+		# when restoring from an uncompressed archive, copy_stream() copies the data without reading it
+		if 'extents' not in extra_data:
+			copy_stream(extra_data['content'], f)
+			return
+		values = map(int, extra_data['extents'].read().split())
+		size, offsets, lengths = values[0], values[1::2], values[2::2]
+		for offset, length in zip(offsets, lengths):
+			f.seek(offset)
+			copy_stream(extra_data['content'], f, length)
+		# skipping over the holes leaves them unallocated, including any at the end
+		f.truncate(size)
+
 
 class SymbolicLinkHandler(SavesFileInfo):
 	"""Handler to re-create symbolic links"""
@@ -51,7 +91,7 @@ class SymbolicLinkHandler(SavesFileInfo):
 
 	@classmethod
 	def match(cls, manifest, filepath):
-		if os.path.islink(filepath):
+		if manifest.stat_cache.islink(filepath):
 			return (), {}
 
 	def get_extra_data(self):
@@ -60,7 +100,7 @@ class SymbolicLinkHandler(SavesFileInfo):
 		return extra_data
 
 	def restore(self, extra_data):
-		os.symlink(extra_data['target'], self.filepath)
+		os.symlink(extra_data['target'].read(), self.filepath)
 		super(SymbolicLinkHandler, self).restore(extra_data)
 
 
@@ -75,8 +115,8 @@ class HandledByParent(Handler):
 	@classmethod
 	def match(cls, manifest, filepath):
 		parent = os.path.dirname(filepath)
-		parent_handler = manifest.files.get(parent, None)
-		if parent_handler and getattr(parent_handler, 'restores_contents', False):
+		parent_record = manifest.files.get(parent, None)
+		if parent_record and getattr(parent_record.cls, 'restores_contents', False):
 			return (), {}
 
 	def restore(self, extra_data):
@@ -32,4 +32,4 @@ class ExampleHandler(Handler):
 		return {"random": data}
 
 	def restore(self, extra_data):
-		print "Example handler: Restoring {} with arg {} and data {}".format(self.filepath, self.value, extra_data['random'])
+		print "Example handler: Restoring {} with arg {} and data {}".format(self.filepath, self.value, extra_data['random'].read())
@@ -1,19 +1,56 @@
 
+import hashlib
 import os
+import shutil
 import tempfile
+from stat import S_IMODE
 
 from easycmd import cmd, FailedProcessError
+from gevent import subprocess
 
 from restore.handler import SavesFileInfo
+from restore.streams import iter_chunks, copy_stream
 
 
-def git(target, command, *args):
+def git(target, command, *args, **kwargs):
+	"""Run git command in target repo, returning its output. kwargs are passed to cmd(), eg. stdin."""
 	if not os.path.isdir(target):
 		target = os.path.dirname(target)
-	return cmd(['git', '-C', target, command] + list(args))
+	return cmd(['git', '-C', target, command] + list(args), **kwargs)
 
 
-def try_get_repo(filepath):
+def git_stream(target, command, *args):
+	"""As git(), but yields the output in chunks as it is produced instead of returning it all at once."""
+	if not os.path.isdir(target):
+		target = os.path.dirname(target)
+	argv = ['git', '-C', target, command] + list(args)
+	proc = subprocess.Popen(argv, stdout=subprocess.PIPE)
+	try:
+		for chunk in iter_chunks(proc.stdout):
+			yield chunk
+	finally:
+		# if we're stopped early, closing stdout will cause git to exit on its next write
+		proc.stdout.close()
+		retcode = proc.wait()
+	if retcode:
+		raise subprocess.CalledProcessError(retcode, argv)
+
+
+def parse_bare(bare):
+	"""Normalise a handler's bare arg, which is a string when loaded from a manifest"""
+	return bare in (True, 'True')
+
+
+# Per-run caches shared by all git handlers, since the same repo is looked at by each of them.
+# {absolute path: (bare, repo path)}, see try_get_repo()
+_repo_cache = {}
+# {absolute repo path: {remote name: fetch url}}, see get_remotes()
+_remotes_cache = {}
+# whether any global git config rewrites urls, see has_global_url_rewrites()
+_global_rewrites = []
+
+
+def try_get_repo(filepath, stat_cache=None):
 	"""For a path, try to find the repo path it is in.
 	Will return either:
 		(True, git dir) for a bare repository
@@ -21,22 +58,187 @@ def try_get_repo(filepath):
 		(None, None) if path is not part of a repo.
 	For performance sake, we make the following assumptions:
 		* Any bare repo will be called "*.git"
-		* Any non-bare repo will contain a ".git" directory
+		* Any non-bare repo will contain a ".git" directory (or a ".git" file pointing to its git dir)
+	Since we only look for repos whose top level is filepath, we never actually need to look at parent directories.
+	If given, stat_cache is used to check for the ".git" directory.
+	Results are cached for the rest of the run.
 	"""
-	# Shortcuts to avoid needing to run git in most cases
-	if filepath.endswith('.git') or os.path.isdir(os.path.join(filepath, '.git')):
+	filepath = os.path.abspath(filepath)
+	if filepath not in _repo_cache:
 		try:
-			repo = git(filepath, 'rev-parse', '--show-toplevel')[:-1] # strip newline
-			if repo:
-				return False, os.path.abspath(repo)
-			else: # bare repository
-				repo = os.path.abspath(git(filepath, 'rev-parse', '--git-dir')[:-1])
-				return True, repo
-		except FailedProcessError:
-			pass
+			_repo_cache[filepath] = find_repo(filepath, stat_cache)
+		except (IOError, OSError, ValueError):
+			# something unusual, let git work it out
+			_repo_cache[filepath] = find_repo_with_git(filepath)
+	return _repo_cache[filepath]
+
+
+def find_repo(filepath, stat_cache=None):
+	"""As try_get_repo(), but works out the answer by reading the repo directly instead of running git.
+	Raises ValueError for cases it doesn't understand."""
+	isdir = stat_cache.isdir if stat_cache else os.path.isdir
+	isfile = stat_cache.isfile if stat_cache else os.path.isfile
+	dotgit = os.path.join(filepath, '.git')
+	if isdir(dotgit):
+		if not is_git_dir(dotgit, isdir, isfile):
+			raise ValueError("{!r} is not a valid git dir".format(dotgit))
+		return False, filepath
+	if isfile(dotgit):
+		# a "gitfile", as used by submodules and worktrees, which points to the real git dir
+		with open(dotgit) as f:
+			content = f.read().strip()
+		if not content.startswith('gitdir: '):
+			raise ValueError("Unknown .git file format in {!r}".format(dotgit))
+		git_dir = os.path.join(filepath, content[len('gitdir: '):])
+		if not is_git_dir(git_dir, isdir, isfile):
+			raise ValueError("{!r} does not point to a valid git dir".format(dotgit))
+		return False, filepath
+	if filepath.endswith('.git') and is_git_dir(filepath, isdir, isfile):
+		return True, filepath
 	return None, None
 
 
+def is_git_dir(path, isdir=os.path.isdir, isfile=os.path.isfile):
+	"""Check if path looks like a git dir, using the same minimal checks as git itself."""
+	return (
+		isfile(os.path.join(path, 'HEAD'))
+		and isdir(os.path.join(path, 'objects'))
+		and isdir(os.path.join(path, 'refs'))
+	)
+
+
+def find_repo_with_git(filepath):
+	"""As try_get_repo(), but by asking git."""
+	try:
+		repo = git(filepath, 'rev-parse', '--show-toplevel')[:-1] # strip newline
+		if repo:
+			return False, os.path.abspath(repo)
+		else: # bare repository
+			repo = os.path.abspath(git(filepath, 'rev-parse', '--git-dir')[:-1])
+			return True, repo
+	except FailedProcessError:
+		return None, None
+
+
+def get_remotes(repo, bare):
+	"""Returns {remote name: fetch url} for the given repo path.
+	Normally this is read from the repo's config directly, but we fall back to running git
+	for anything that would be affected by config we don't understand, eg. url rewriting or includes.
+	Results are cached for the rest of the run.
+	"""
+	if repo not in _remotes_cache:
+		try:
+			if has_global_url_rewrites():
+				raise ValueError("Global git config rewrites urls")
+			git_dir = repo if bare else get_git_dir(repo)
+			_remotes_cache[repo] = read_remotes(os.path.join(git_dir, 'config'))
+		except (IOError, OSError, ValueError):
+			_remotes_cache[repo] = get_remotes_with_git(repo)
+	return _remotes_cache[repo]
+
+
+def get_git_dir(repo):
+	"""For a non-bare repo, return its git dir"""
+	dotgit = os.path.join(repo, '.git')
+	if os.path.isdir(dotgit):
+		return dotgit
+	with open(dotgit) as f:
+		return os.path.join(repo, f.read().strip()[len('gitdir: '):])
+
+
+def read_remotes(config_path):
+	"""Read {remote name: fetch url} from a git config file.
+	Raises ValueError if the config contains anything which might change the answer that we don't handle.
+	"""
+	remotes = {}
+	for section, subsection, key, value in read_git_config(config_path):
+		if section == 'include' or section == 'includeif':
+			raise ValueError("Config {!r} includes other files".format(config_path))
+		if section == 'url' and key in ('insteadof', 'pushinsteadof'):
+			raise ValueError("Config {!r} rewrites urls".format(config_path))
+		# the first url is used for fetching
+		if section == 'remote' and subsection is not None and key == 'url' and subsection not in remotes:
+			remotes[subsection] = value
+	return remotes
+
+
+def read_git_config(config_path):
+	"""Parse a git config file, yielding (section, subsection, key, value) for each entry.
+	Section and key names are case-insensitive, so are returned lowercased. subsection is None if not given.
+	This handles the common subset of the format. Raises ValueError for anything else.
+	"""
+	section = subsection = None
+	with open(config_path) as f:
+		for line in f:
+			line = line.strip()
+			if not line or line[0] in '#;':
+				continue
+			if line.startswith('['):
+				header, sep, rest = line[1:].partition(']')
+				if not sep or (rest.strip() and rest.strip()[0] not in '#;'):
+					raise ValueError("Unsupported section header: {!r}".format(line))
+				if '"' in header:
+					section, quoted = header.split(None, 1)
+					if not (quoted.startswith('"') and quoted.endswith('"')) or '\\' in quoted:
+						raise ValueError("Unsupported section header: {!r}".format(line))
+					subsection = quoted[1:-1]
+				elif '.' in header:
+					# deprecated [section.subsection] syntax, where subsection is case-insensitive
+					section, subsection = header.split('.', 1)
+					subsection = subsection.lower()
+				else:
+					section, subsection = header.strip(), None
+				section = section.lower()
+				continue
+			if section is None:
+				raise ValueError("Entry outside of any section: {!r}".format(line))
+			key, sep, value = line.partition('=')
+			key = key.strip().lower()
+			value = value.strip()
+			if not sep:
+				value = 'true' # a key with no value is a boolean true
+			elif any(c in value for c in '"\\#;'):
+				# quoting, escapes, line continuations and comments
+				raise ValueError("Unsupported value: {!r}".format(line))
+			yield section, subsection, key, value
+
+
+def has_global_url_rewrites():
+	"""Returns whether any system or user git config might rewrite urls, or include other config.
+	This is only checked once per run."""
+	if not _global_rewrites:
+		paths = [
+			'/etc/gitconfig',
+			os.path.join(os.environ.get('XDG_CONFIG_HOME', os.path.expanduser('~/.config')), 'git/config'),
+			os.path.expanduser('~/.gitconfig'),
+		]
+		found = False
+		for path in paths:
+			try:
+				with open(path) as f:
+					content = f.read().lower()
+			except (IOError, OSError):
+				continue
+			if 'insteadof' in content or '[include' in content:
+				found = True
+		_global_rewrites.append(found)
+	return _global_rewrites[0]
+
+
+def get_remotes_with_git(repo):
+	"""As get_remotes(), but by asking git."""
+	remotes = {}
+	for remote_name in filter(None, git(repo, 'remote').split('\n')):
+		remote_info = git(repo, 'remote', 'show', '-n', remote_name) # -n means don't query remote
+		for line in remote_info.strip().split('\n'):
+			if line.startswith('  Fetch URL: '):
+				remotes[remote_name] = line[len('  Fetch URL: '):]
+				break
+		else:
+			raise ValueError("Bad output from git remote show {}: {!r}".format(remote_name, remote_info))
+	return remotes
+
+
 class GitCloneHandler(SavesFileInfo):
 	"""A handler that matches git repositories that have at least one remote.
 	The restore action is to clone from that remote.
@@ -55,35 +257,28 @@ class GitCloneHandler(SavesFileInfo):
 
 	name = 'git-clone'
 	restores_contents = True
+	restore_in_thread = False # runs git as a gevent subprocess
 
 	@classmethod
 	def match(cls, manifest, filepath):
 		# is it a directory?
-		if not os.path.isdir(filepath):
+		if not manifest.stat_cache.isdir(filepath):
 			return
 		# is it a repo?
-		bare, repo = try_get_repo(filepath)
+		bare, repo = try_get_repo(filepath, manifest.stat_cache)
 		if repo is None or repo != os.path.abspath(filepath):
 			return
 		# does it have a remote?
-		remotes = filter(None, git(filepath, 'remote').split('\n'))
+		remotes = get_remotes(repo, bare)
 		if not remotes:
 			return
-		# multiple remotes: prefer 'origin' by default, otherwise pick first one
-		remote_name = 'origin' if 'origin' in remotes else remotes[0]
-		# get fetch url
-		remote_info = git(filepath, 'remote', 'show', '-n', remote_name) # -n means don't query remote
-		for line in remote_info.strip().split('\n'):
-			if line.startswith('  Fetch URL: '):
-				remote = line[len('  Fetch URL: '):]
-				break
-		else:
-			raise ValueError("Bad output from git remote show {}: {!r}".format(remote_name, remote_info))
-		return (remote,), {'bare': bare}
+		# multiple remotes: prefer 'origin' by default, otherwise pick first one (in the same order git lists them)
+		remote_name = 'origin' if 'origin' in remotes else sorted(remotes)[0]
+		return (remotes[remote_name],), {'bare': bare}
 
 	def __init__(self, manifest, filepath, remote, bare=False):
 		self.remote = remote
-		self.bare = bare
+		self.bare = parse_bare(bare)
 		super(GitCloneHandler, self).__init__(manifest, filepath)
 
 	def get_args(self):
@@ -115,41 +310,159 @@ class GitBundleHandler(SavesFileInfo):
 	It will save "oddly" referenced commits, eg. stash. But it won't automatically recover them
 		(you can still get them back by commit id).
 	It will not save any per-repo hooks or config (eg. remotes), it is similar to a re-clone.
-	
+
+	In incremental archives, the repo is only stored again if its refs have changed, and then only
+	as a "thin" bundle of the new commits. Restoring applies each bundle back to the last full one in order.
+
 	This handler matches against the top level directory of the repo, or the git dir if bare.
 	The files inside the repo and git dir will be HandledByParent.
 	"""
 
 	name = 'git-bundle'
 	restores_contents = True
+	# runs git as a gevent subprocess
+	collect_in_thread = False
+	restore_in_thread = False
 
 	@classmethod
 	def match(cls, manifest, filepath):
 		# is it a directory?
-		if not os.path.isdir(filepath):
+		if not manifest.stat_cache.isdir(filepath):
 			return
 		# is it a repo?
-		bare, repo = try_get_repo(filepath)
+		bare, repo = try_get_repo(filepath, manifest.stat_cache)
 		if repo is None or repo != os.path.abspath(filepath):
 			return
 		return (), {'bare': bare}
 
 	def __init__(self, manifest, filepath, bare=False):
-		self.bare = bare
+		self.bare = parse_bare(bare)
 		super(GitBundleHandler, self).__init__(manifest, filepath)
 
 	def get_args(self):
 		return (), {'bare': self.bare}
 
+	def get_fingerprint(self):
+		# Changes to refs don't show up in the repo directory's stat info, so we fingerprint the refs themselves,
+		# plus the directory's mode and ownership which are also saved.
+		# The fingerprint ends with the commits the refs point to, so that the next incremental archive
+		# can store only the commits since then. See get_incremental_extra_data().
+		stat = self.manifest.stat_cache.stat(self.filepath)
+		refs = self.get_refs()
+		if stat is None or not refs:
+			return None
+		tips = sorted(set(line.split(' ', 1)[0] for line in refs.splitlines()))
+		return "{} {} {} {} {}".format(
+			S_IMODE(stat.st_mode), stat.st_uid, stat.st_gid, hashlib.sha1(refs).hexdigest(), ' '.join(tips),
+		)
+
+	def get_refs(self):
+		"""Returns the output of git show-ref for all refs including HEAD, ie. lines of "{commit} {ref}",
+		or '' if there are no refs."""
+		try:
+			return git(self.filepath, 'show-ref', '--head')
+		except FailedProcessError:
+			return ''
+
 	def get_extra_data(self):
 		extra_data = super(GitBundleHandler, self).get_extra_data()
-		extra_data['bundle'] = git(self.filepath, 'bundle', 'create', '-', '--all')
+		extra_data['refs'] = self.get_refs()
+		extra_data['basis'] = ''
+		# bundle size isn't known in advance, so it's spooled ahead of the archive writer to find out
+		extra_data['bundle'] = git_stream(self.filepath, 'bundle', 'create', '-', '--all')
+		return extra_data
+
+	def get_incremental_extra_data(self, previous_fingerprint):
+		"""Stores a thin bundle, containing only the commits that aren't reachable from the refs as they were in the
+		base archive. Falls back to a full bundle if any of those commits are gone (eg. after a force push and gc),
+		or if there are no new commits (eg. the only change is a deleted branch), since git won't make an empty bundle.
+		"""
+		basis = previous_fingerprint.split(' ')[4:]
+		if basis:
+			# cat-file prints "{object} missing" for any object that doesn't exist
+			output = git(self.filepath, 'cat-file', '--batch-check', stdin=''.join(oid + '\n' for oid in basis))
+			if any(line.endswith(' missing') for line in output.splitlines()):
+				basis = []
+		if basis:
+			new_commits = git(self.filepath, 'rev-list', '--count', '--all', '--not', *basis)
+			if int(new_commits) == 0:
+				basis = []
+		if not basis:
+			return self.get_extra_data()
+		extra_data = super(GitBundleHandler, self).get_extra_data()
+		extra_data['refs'] = self.get_refs()
+		extra_data['basis'] = '\n'.join(basis)
+		extra_data['bundle'] = git_stream(self.filepath, 'bundle', 'create', '-', '--all', '--not', *basis)
 		return extra_data
 
 	def restore(self, extra_data):
-		# There seems to be no way to git clone from a bundle on stdin, so we use a tempfile
-		with tempfile.NamedTemporaryFile() as f:
-			f.write(extra_data['bundle'])
-			f.flush()
-			cmd(['git', 'clone', '-o', 'bundle', f.name, self.filepath])
-		super(GitBundleHandler, self).restore(extra_data)
+		self.restore_from_history(iter([extra_data]))
+
+	def restore_from_history(self, history):
+		"""Restores from the most recent full bundle, then applies each later thin bundle in order."""
+		# collect data from each archive back to the most recent full bundle.
+		# archives from before thin bundles were supported have no basis key, and always have full bundles.
+		chain = []
+		for extra_data in history:
+			chain.append(extra_data)
+			if 'basis' not in extra_data or not extra_data['basis'].read():
+				break
+		else:
+			raise ValueError("Bad archive: No full git bundle found for {!r}".format(self.filepath))
+
+		flags = ['--bare'] if self.bare else []
+		if len(chain) == 1:
+			# There seems to be no way to git clone from a bundle on stdin, so we use a tempfile
+			with tempfile.NamedTemporaryFile() as f:
+				copy_stream(chain[0]['bundle'], f)
+				f.flush()
+				cmd(['git', 'clone', '-o', 'bundle'] + flags + [f.name, self.filepath])
+		else:
+			# apply the bundles in order to a temporary repo, then clone that
+			staging = tempfile.mkdtemp()
+			try:
+				cmd(['git', 'init', '-q', '--bare', staging])
+				for extra_data in reversed(chain):
+					with tempfile.NamedTemporaryFile() as f:
+						copy_stream(extra_data['bundle'], f)
+						f.flush()
+						cmd(['git', '-C', staging, 'fetch', '-q', f.name, '+refs/*:refs/*'])
+				# thin bundles only contain the refs that changed, and never remove refs,
+				# so set the refs to exactly what they were when the last bundle was made
+				set_refs(staging, chain[0]['refs'].read())
+				cmd(['git', 'clone', '-o', 'bundle'] + flags + [staging, self.filepath])
+			finally:
+				shutil.rmtree(staging)
+		super(GitBundleHandler, self).restore(chain[0])
+
+
+def set_refs(repo, refs):
+	"""Set the refs of repo to exactly those given, in the format returned by git show-ref --head.
+	All the commits must already be present in the repo. HEAD is pointed at a branch if one matches,
+	preferring master, otherwise it is detached."""
+	wanted = {}
+	head = None
+	for line in refs.splitlines():
+		oid, ref = line.split(' ', 1)
+		if ref == 'HEAD':
+			head = oid
+		else:
+			wanted[ref] = oid
+	try:
+		current = git(repo, 'show-ref')
+	except FailedProcessError:
+		current = '' # no refs
+	commands = ["update {} {}\n".format(ref, oid) for ref, oid in sorted(wanted.items())]
+	for line in current.splitlines():
+		ref = line.split(' ', 1)[1]
+		if ref not in wanted:
+			commands.append("delete {}\n".format(ref))
+	cmd(['git', '-C', repo, 'update-ref', '--stdin'], stdin=''.join(commands))
+	if head is not None:
+		branches = sorted(ref for ref, oid in wanted.items() if ref.startswith('refs/heads/') and oid == head)
+		if 'refs/heads/master' in branches:
+			cmd(['git', '-C', repo, 'symbolic-ref', 'HEAD', 'refs/heads/master'])
+		elif branches:
+			cmd(['git', '-C', repo, 'symbolic-ref', 'HEAD', branches[0]])
+		else:
+			cmd(['git', '-C', repo, 'update-ref', '--no-deref', 'HEAD', head])
@@ -1,14 +1,31 @@
 
+import fnmatch
 import os
 import re
 
 from restore.handler import Handler
 
 
+def split_env_list(value):
+	"""Split a list of items seperated by :, where : may be escaped as \:"""
+	items = re.split(r'(?<!\\):', value)
+	return [item.replace(r"\:", ":") for item in items]
+
+
+def compile_globs(globs):
+	"""Combine glob patterns into one regex, or None if there are none."""
+	if not globs:
+		return None
+	return re.compile('|'.join('(?:{})'.format(fnmatch.translate(glob)) for glob in sorted(globs)))
+
+
 class IgnoreHandler(Handler):
 	"""A handler that does not re-create the file, for temporary files and others you do not wish to save.
 	Automatically matches on certain file extensions and hard-coded paths.
 	Specify additional paths to match using env var MATCH_IGNORE (seperate paths with : and escape : as \: )
+	Specify glob patterns to match using env var MATCH_IGNORE_GLOBS, in the same format.
+	Patterns containing a / match against the whole path, others against the file name only,
+	eg. "node_modules" or "*.o".
 	"""
 
 	name = 'ignore'
@@ -23,15 +40,45 @@ class IgnoreHandler(Handler):
 		'/var/cache',
 	}
 	if 'MATCH_IGNORE' in os.environ:
-		_paths = re.split(r'(?<!\\):', os.environ['MATCH_IGNORE'])
-		_paths = [_path.replace(r"\:", ":") for _path in _paths]
-		MATCH_PATHS |= set(_paths)
+		MATCH_PATHS |= set(split_env_list(os.environ['MATCH_IGNORE']))
+	# match on these glob patterns
+	MATCH_GLOBS = set()
+	if 'MATCH_IGNORE_GLOBS' in os.environ:
+		MATCH_GLOBS |= set(split_env_list(os.environ['MATCH_IGNORE_GLOBS']))
+
+	# (globs, name regex, path regex) for the MATCH_GLOBS that the regexes were compiled from
+	_compiled_globs = None
+
+	@classmethod
+	def get_glob_regexes(cls):
+		"""Returns (name regex, path regex), each combining all the relevant MATCH_GLOBS,
+		or None if there are no such globs."""
+		globs = frozenset(cls.MATCH_GLOBS)
+		if cls._compiled_globs is None or cls._compiled_globs[0] != globs:
+			name_globs = [glob for glob in globs if '/' not in glob]
+			path_globs = [glob for glob in globs if '/' in glob]
+			cls._compiled_globs = globs, compile_globs(name_globs), compile_globs(path_globs)
+		return cls._compiled_globs[1:]
+
+	@classmethod
+	def is_ignored(cls, filepath):
+		"""Returns whether filepath should be ignored, based only on the path itself."""
+		if any(filepath.endswith(ext) for ext in cls.MATCH_EXTENSIONS):
+			return True
+		filepath = os.path.abspath(filepath)
+		if filepath in cls.MATCH_PATHS:
+			return True
+		name_regex, path_regex = cls.get_glob_regexes()
+		if name_regex and name_regex.match(os.path.basename(filepath)):
+			return True
+		if path_regex and path_regex.match(filepath):
+			return True
+		return False
 
 	@classmethod
 	def match(cls, manifest, filepath):
-		if (any(filepath.endswith(ext) for ext in cls.MATCH_EXTENSIONS) or
-		    os.path.abspath(filepath) in cls.MATCH_PATHS):
+		if cls.is_ignored(filepath):
 			return (), {}
 
-	def restore(self):
+	def restore(self, extra_data):
 		pass
@@ -1,14 +1,27 @@
 
+import gzip
+import hashlib
+import multiprocessing
 import os
+import re
+import shlex
+import tempfile
+from stat import S_IMODE, S_ISLNK, S_ISREG
 
 import gevent
-from gevent import subprocess
-from gevent.event import Event
+from gevent.threadpool import ThreadPool
 
 from easycmd import cmd
-from gtools import get_first
 
 from restore.handler import Handler
+from restore.pathindex import PathIndex
+from restore.streams import iter_chunks
+
+
+# Max number of threads to use for hashing files, to check if they've been modified since they were installed.
+# Hashing doesn't hold the GIL, so this is how many files can be hashed in parallel.
+# May be overridden by env var of the same name.
+PACKAGE_HASH_THREADS_MAX = int(os.environ.get('PACKAGE_HASH_THREADS_MAX', multiprocessing.cpu_count()))
 
 
 class PackageHandler(Handler):
@@ -17,62 +30,47 @@ class PackageHandler(Handler):
 	Certain actions need to be implemented by a subclass for a specific package manager.
 	"""
 
-	# per-subcls dict maps files to owning package
-	# if a file is not found, and indexing is not finished,
-	# an event can be left to notify upon the file being set.
-	package_index = None
-	# holds the greenlet that is indexing
+	# holds the greenlet that is loading the per-subcls index of what package owns what file.
+	# Its result is an object with a get(filepath) method, see load_index().
 	indexer = None
+	# package managers generally lock their database, so we can't run two installs at once anyway
+	serial_restore = True
+	batch_restore = True
 
 	@classmethod
-	def get_package(cls, filepath):
-		"""Looks up what package owns the given file. Returns package name or None on no match."""
-		filepath = os.path.abspath(filepath)
-		if cls.package_index is None:
-			cls.package_index = {} # by creating like this, the dict is cls specific,
-			                       # instead of shared between all subclasses of PackageHandler
-
+	def get_index_entry(cls, filepath):
+		"""Looks up filepath in the index. Returns the owning package, followed by a space and any extra info
+		the subclass stores for the file (see load_index()), or None on no match."""
 		if cls.indexer is None:
-			# start indexing
-			cls.indexer = gevent.spawn(cls.index_packages)
-
-		result = cls.package_index.get(filepath, None)
-
-		if not result:
-			# it's not there yet - leave a marker to tell us if it's found
-			result = Event()
-			cls.package_index[filepath] = result
-
-		if isinstance(result, Event):
-			# wait for it to be found, or for indexing to finish
-			get_first(result.wait, cls.indexer.get)
-			new_result = cls.package_index.get(filepath, None)
-			# if the file wasn't found, we need to clear the waiting event
-			if new_result is result:
-				del cls.package_index[filepath]
-				result = None
-			else:
-				result = new_result
-
-		# result is now either the package, or None
-		return result
+			# the index is loaded from files with blocking I/O, so we do it in a thread.
+			# Setting this on cls makes it specific to the subclass, not shared between all package handlers.
+			cls.indexer = gevent.get_hub().threadpool.spawn(cls.load_index)
+		return cls.indexer.get().get(os.path.abspath(filepath))
 
 	@classmethod
-	def set_package(cls, filepath, package):
-		"""Tell the package index that filepath is owned by the given package."""
-		if cls.package_index is None:
-			cls.package_index = {} # just in case this is called before indexing starts
-		current = cls.package_index.get(filepath, None)
-		if isinstance(current, Event):
-			current.set()
-		cls.package_index[filepath] = package
+	def get_package(cls, filepath):
+		"""Looks up what package owns the given file. Returns package name or None on no match."""
+		entry = cls.get_index_entry(filepath)
+		if entry:
+			return entry.partition(' ')[0]
 
 	@classmethod
 	def match(cls, manifest, filepath):
-		package = cls.get_package(filepath)
-		if package:
+		entry = cls.get_index_entry(filepath)
+		if not entry:
+			return
+		package, _, info = entry.partition(' ')
+		if cls.is_unmodified(manifest, filepath, info):
 			return (package,), {}
 
+	@classmethod
+	def is_unmodified(cls, manifest, filepath, info):
+		"""Returns whether the file is as installed by its package, so that installing the package restores it.
+		info is the extra info from the file's index entry.
+		Defaults to True, for package managers which can't tell.
+		"""
+		return True
+
 	def __init__(self, manifest, filepath, package):
 		super(PackageHandler, self).__init__(manifest, filepath)
 		self.package = package
@@ -81,46 +79,352 @@ class PackageHandler(Handler):
 		return (self.package,), {}
 
 	def restore(self, extra_data):
-		try:
-			if self.check_package(self.package):
-				return
-		except subprocess.CalledProcessError:
-			pass
-		self.install_package(self.package)
+		self.restore_batch([self], None)
 
 	@classmethod
-	def index_packages(cls):
+	def restore_batch(cls, handlers, archive):
+		# many files share each package, and package managers are much faster at installing
+		# many packages in one go, so we only check and install each package once.
+		packages = set(handler.package for handler in handlers)
+		missing = packages - cls.installed_packages(packages)
+		if missing:
+			cls.logger.info("Installing {} packages".format(len(missing)))
+			cls.install_packages(sorted(missing))
+
+	@classmethod
+	def load_index(cls):
 		"""Actually does the work of indexing what package owns what file.
-		This must be implemented by a subclass.
-		The implementation should not insert values into package_index directly, but instead
-		use cls.set_package(filepath, package).
+		This must be implemented by a subclass, returning an object with a get(filepath) method
+		which returns the package owning the absolute filepath, or None (eg. a dict or PathIndex).
+		The package name may be followed by a space and extra info, which is passed to is_unmodified().
+		It is run in a thread, so should not use gevent.
 		"""
 		raise NotImplementedError
 
-	def check_package(self, package):
-		"""This method should return whether the given package is installed.
-		To cover a common case, it will treat subprocess.CalledProcessError as False."""
+	@classmethod
+	def installed_packages(cls, packages):
+		"""This method should return the set of the given packages which are installed."""
 		raise NotImplementedError
 
-	def install_package(self, package):
-		"""This method should do the actual package installation"""
+	@classmethod
+	def install_packages(cls, packages):
+		"""This method should do the actual package installation, for a sorted list of packages."""
 		raise NotImplementedError
 
 
+def cache_path(filename):
+	"""Returns the path to filename in our cache directory"""
+	cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+	return os.path.join(cache_home, 'restore', filename)
+
+
+def load_cached_index(index_path, db_path, iter_owned_files, index_format=1):
+	"""Open the PathIndex at index_path, first (re)building it from iter_owned_files() if it's missing
+	or if the package database at db_path has changed since it was built.
+	We assume the database directory's mtime changes whenever a package is installed, upgraded or removed.
+	index_format should be changed whenever the handler changes what it stores in the index."""
+	stamp = "{} {} {!r}".format(index_format, os.path.abspath(db_path), os.stat(db_path).st_mtime)
+	index = PathIndex.open(index_path, stamp)
+	if index is None:
+		try:
+			PathIndex.build(index_path, stamp, iter_owned_files())
+		except EnvironmentError:
+			# we can't write to the cache, so build a private index for this run only
+			index_path = os.path.join(tempfile.mkdtemp(prefix='restore-'), os.path.basename(index_path))
+			PathIndex.build(index_path, stamp, iter_owned_files())
+		index = PathIndex.open(index_path, stamp)
+		if index is None:
+			raise ValueError("Failed to open newly built package index {!r}".format(index_path))
+	return index
+
+
 class PacmanHandler(PackageHandler):
-	"""Package handler for archlinux's pacman package manager"""
+	"""Package handler for archlinux's pacman package manager.
+	Only files which haven't been modified since they were installed match, as checked against
+	the size, mode and sha256 (or for symlinks, the target) in the package's mtree file in pacman's database.
+	"""
 
 	name = 'pacman'
 
+	# pacman's database of installed packages, one directory per package
+	DB_PATH = os.environ.get('PACMAN_DB_PATH', '/var/lib/pacman/local')
+	# where we keep our index of which package owns each file, which is rebuilt when the database changes
+	INDEX_PATH = os.environ.get('PACMAN_INDEX_PATH') or cache_path('pacman-files.idx')
+	# the command to run pacman, eg. to use a wrapper or a stub for testing
+	command = shlex.split(os.environ.get('PACMAN_COMMAND', 'pacman'))
+
+	@classmethod
+	def load_index(cls):
+		if not os.path.isdir(cls.DB_PATH):
+			cls.logger.info("No pacman database found at {!r}, no files will match".format(cls.DB_PATH))
+			return {}
+		return load_cached_index(cls.INDEX_PATH, cls.DB_PATH, cls.iter_owned_files, index_format=2)
+
+	@classmethod
+	def iter_owned_files(cls):
+		"""Read the database directly, yielding (filepath, "{package} {info}") for each file owned by a package.
+		info is either "file {size} {mode} {mtime} {install time} {sha256}" or "link {target}".
+		The install time is the mtime of the package's file list, which pacman writes after installing the files.
+		Directories (which may be owned by many packages) aren't included, nor are files which aren't
+		in the package's mtree, since we can't check if they've been modified.
+		"""
+		for entry in sorted(os.listdir(cls.DB_PATH)):
+			package_dir = os.path.join(cls.DB_PATH, entry)
+			if not os.path.isdir(package_dir):
+				continue # eg. ALPM_DB_VERSION
+			sections = read_pacman_db_file(os.path.join(package_dir, 'desc'), {'%NAME%'})
+			package = sections['%NAME%'][0]
+			files_path = os.path.join(package_dir, 'files')
+			installed = os.stat(files_path).st_mtime
+			sections = read_pacman_db_file(files_path, {'%FILES%'})
+			mtree = read_mtree(os.path.join(package_dir, 'mtree'))
+			for filepath in sections.get('%FILES%', ()):
+				if filepath.endswith('/'):
+					continue
+				attrs = mtree.get(filepath)
+				if attrs is None:
+					continue
+				file_type = attrs.get('type', 'file')
+				if file_type == 'file' and all(key in attrs for key in ('size', 'mode', 'time', 'sha256digest')):
+					info = "file {} {} {} {!r} {}".format(
+						attrs['size'], attrs['mode'], attrs['time'], installed, attrs['sha256digest'],
+					)
+				elif file_type == 'link' and 'link' in attrs:
+					info = "link {}".format(unescape_mtree(attrs['link']))
+				else:
+					continue
+				yield '/' + filepath, "{} {}".format(package, info)
+
+	@classmethod
+	def is_unmodified(cls, manifest, filepath, info):
+		file_type, _, info = info.partition(' ')
+		stat = manifest.stat_cache.lstat(filepath)
+		if stat is None:
+			return False
+		if file_type == 'link':
+			return S_ISLNK(stat.st_mode) and os.readlink(filepath) == info
+		size, mode, mtime, installed, sha256 = info.split(' ')
+		# cheap checks first, so most files are never read
+		if not S_ISREG(stat.st_mode) or stat.st_size != int(size) or S_IMODE(stat.st_mode) != int(mode, 8):
+			return False
+		# If nothing about the file has changed since it was installed (including its ctime, which can't be set
+		# by the user), it's as installed. Otherwise, we need to check its contents.
+		if int(stat.st_mtime) == int(float(mtime)) and stat.st_ctime <= float(installed):
+			return True
+		return hash_file(filepath, 'sha256') == sha256
+
+	@classmethod
+	def installed_packages(cls, packages):
+		return packages & set(cmd(cls.command + ['-Qq']).split())
+
+	@classmethod
+	def install_packages(cls, packages):
+		cmd(cls.command + ['-Sy', '--needed', '--noconfirm'] + list(packages))
+
+
+def read_pacman_db_file(filepath, wanted):
+	"""Parse a file from the pacman database, which consists of sections like:
+		%NAME%
+		value
+		value
+
+	Returns {section name: [values]} for sections in wanted.
+	"""
+	sections = {}
+	values = None
+	with open(filepath) as f:
+		for line in f:
+			line = line.rstrip('\n')
+			if line.startswith('%') and line.endswith('%') and len(line) > 1:
+				values = sections.setdefault(line, []) if line in wanted else None
+			elif line and values is not None:
+				values.append(line)
+	return sections
+
+
+class DpkgHandler(PackageHandler):
+	"""Package handler for debian's dpkg, installing packages with apt.
+	Only files which haven't been modified since they were installed match, as checked against
+	the md5sums in dpkg's database (or for config files, the md5s in dpkg's status file).
+	Since dpkg doesn't record file times, matching files are always hashed.
+	"""
+
+	name = 'dpkg'
+
+	# dpkg's database of installed packages, with files {package}.list and {package}.md5sums for each package
+	DB_PATH = os.environ.get('DPKG_INFO_PATH', '/var/lib/dpkg/info')
+	# the status of each package, which includes the md5s of their config files
+	STATUS_PATH = os.environ.get('DPKG_STATUS_PATH') or os.path.join(os.path.dirname(DB_PATH), 'status')
+	# where we keep our index of which package owns each file, which is rebuilt when the database changes
+	INDEX_PATH = os.environ.get('DPKG_INDEX_PATH') or cache_path('dpkg-files.idx')
+	# the commands to run dpkg-query and apt-get, eg. to use a wrapper or a stub for testing
+	query_command = shlex.split(os.environ.get('DPKG_QUERY_COMMAND', 'dpkg-query'))
+	apt_command = shlex.split(os.environ.get('APT_COMMAND', 'apt-get'))
+
+	@classmethod
+	def load_index(cls):
+		if not os.path.isdir(cls.DB_PATH):
+			cls.logger.info("No dpkg database found at {!r}, no files will match".format(cls.DB_PATH))
+			return {}
+		return load_cached_index(cls.INDEX_PATH, cls.DB_PATH, cls.iter_owned_files, index_format=2)
+
+	@classmethod
+	def iter_owned_files(cls):
+		"""Read the database directly, yielding (filepath, "{package} {md5} {install time} {kind}") for each file
+		owned by a package which has a known md5. This leaves out directories and symlinks.
+		kind is "conffile" for config files and "file" otherwise.
+		The install time is the mtime of the package's file list, which dpkg writes after installing the files."""
+		conffiles = read_dpkg_conffiles(cls.STATUS_PATH)
+		for entry in sorted(os.listdir(cls.DB_PATH)):
+			if not entry.endswith('.list'):
+				continue
+			# packages which may be installed for multiple architectures are named like "package:arch"
+			package = entry[:-len('.list')]
+			list_path = os.path.join(cls.DB_PATH, entry)
+			installed = os.stat(list_path).st_mtime
+			md5sums = read_dpkg_md5sums(os.path.join(cls.DB_PATH, package + '.md5sums'))
+			with open(list_path) as f:
+				for line in f:
+					filepath = line.rstrip('\n')
+					if filepath in conffiles:
+						md5, kind = conffiles[filepath], 'conffile'
+					else:
+						md5, kind = md5sums.get(filepath), 'file'
+					if md5:
+						yield filepath, "{} {} {!r} {}".format(package, md5, installed, kind)
+
+	@classmethod
+	def is_unmodified(cls, manifest, filepath, info):
+		md5, installed, kind = info.split(' ')
+		stat = manifest.stat_cache.lstat(filepath)
+		if stat is None or not S_ISREG(stat.st_mode):
+			return False
+		# Unlike pacman, dpkg doesn't record the packaged mtime of each file, so we can't tell from its times
+		# that a file is unchanged. In particular, the file list is rewritten on every upgrade, but modified
+		# config files are kept through upgrades, so a file being older than its list means nothing.
+		# We can only use the times the other way: a regular file whose contents changed after it was
+		# installed has been modified. Config files are always hashed, since they're the files users edit.
+		if kind != 'conffile' and stat.st_mtime > float(installed):
+			return False
+		return hash_file(filepath, 'md5') == md5
+
+	@classmethod
+	def installed_packages(cls, packages):
+		# binary:Package includes the architecture for packages installed for multiple architectures,
+		# matching the names of their file lists
+		output = cmd(cls.query_command + ['-W', '-f', '${binary:Package} ${db:Status-Abbrev}\n'])
+		installed = set()
+		for line in output.splitlines():
+			package, _, status = line.partition(' ')
+			if status.startswith('ii'):
+				installed.add(package)
+		return packages & installed
+
 	@classmethod
-	def index_packages(cls):
-		data = cmd(['pacman', '-Ql'])
-		for line in data.strip().split('\n'):
-			package, filepath = line.split(' ', 1)
-			cls.set_package(filepath, package)
+	def install_packages(cls, packages):
+		cmd(cls.apt_command + ['update'])
+		cmd(cls.apt_command + ['install', '-y', '--no-install-recommends'] + list(packages))
+
+
+def read_mtree(filepath):
+	"""Parse a (gzipped) mtree file, as found in pacman's database for each package. It lists each file like:
+		./usr/bin/foo time=1600000000.0 mode=755 size=1234 sha256digest={sha256}
+	where keywords which aren't given take the defaults from the most recent "/set" line.
+	Returns {filepath relative to /: {keyword: value}}, which is empty if the file doesn't exist.
+	"""
+	entries = {}
+	defaults = {}
+	try:
+		f = gzip.open(filepath)
+	except IOError:
+		return entries
+	with f:
+		for line in f:
+			words = line.split()
+			if not words or words[0].startswith('#'):
+				continue
+			keywords = dict(word.partition('=')[::2] for word in words[1:])
+			if words[0] == '/set':
+				defaults.update(keywords)
+			elif words[0] == '/unset':
+				for keyword in keywords:
+					defaults.pop(keyword, None)
+			else:
+				path = unescape_mtree(words[0])
+				if path.startswith('./'):
+					path = path[2:]
+				attrs = defaults.copy()
+				attrs.update(keywords)
+				entries[path] = attrs
+	return entries
+
+
+def unescape_mtree(value):
+	"""Decode the octal escapes (eg. "\\040" for a space) used for special characters in mtree files"""
+	return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)), value)
+
+
+def read_dpkg_md5sums(filepath):
+	"""Parse a package's md5sums file, with lines like "{md5}  {filepath relative to /}".
+	Returns {absolute filepath: md5}, which is empty if the package has no md5sums file."""
+	md5sums = {}
+	try:
+		f = open(filepath)
+	except IOError:
+		return md5sums
+	with f:
+		for line in f:
+			md5, _, path = line.rstrip('\n').partition('  ')
+			md5sums['/' + path] = md5
+	return md5sums
+
+
+def read_dpkg_conffiles(filepath):
+	"""Parse dpkg's status file for the config files of all installed packages, which are listed like:
+		Conffiles:
+		 /etc/foo {md5}
+		 /etc/bar {md5} obsolete
+
+	Returns {filepath: md5}, leaving out obsolete config files since their package no longer provides them.
+	"""
+	conffiles = {}
+	if not os.path.exists(filepath):
+		return conffiles
+	in_conffiles = False
+	with open(filepath) as f:
+		for line in f:
+			if not line.startswith(' '):
+				in_conffiles = line.startswith('Conffiles:')
+				continue
+			if not in_conffiles:
+				continue
+			line = line.strip()
+			if line.endswith(' obsolete'):
+				continue
+			path, _, md5 = line.rpartition(' ')
+			if len(md5) == 32: # new config files not yet unpacked have a md5 of "newconffile"
+				conffiles[path] = md5
+	return conffiles
+
+
+_hash_pool = None
+
+
+def hash_file(filepath, algorithm):
+	"""Returns the hex digest of filepath's contents with the given hashlib algorithm (eg. 'md5'),
+	or None if it can't be read. Files are hashed in a thread pool, see PACKAGE_HASH_THREADS_MAX."""
+	global _hash_pool
+	if _hash_pool is None:
+		_hash_pool = ThreadPool(PACKAGE_HASH_THREADS_MAX)
+	return _hash_pool.apply(_hash_file, (filepath, algorithm))
 
-	def check_package(self, package):
-		cmd(['pacman', '-Qq', package])
 
-	def install_package(self, package):
-		cmd(['pacman', '-Sy', '--noconfirm', package])
+def _hash_file(filepath, algorithm):
+	hasher = hashlib.new(algorithm)
+	try:
+		with open(filepath, 'rb') as f:
+			for chunk in iter_chunks(f):
+				hasher.update(chunk)
+	except EnvironmentError:
+		return None
+	return hasher.hexdigest()
@@ -1,55 +1,125 @@
 
 import os
+from cStringIO import StringIO
 
-from gevent.event import Event
-from gevent.lock import Semaphore, DummySemaphore, RLock
-
-import gtools
+from gevent.pool import Pool
 
+from depgraph import DependencyGraph, parent_path
 from handler import Handler
 from handlers import DEFAULT_HANDLERS
+from handlers.basics import HandledByParent
+from handlers.ignore import IgnoreHandler
+from owners import OwnerCache
+from pipeline import restore_files
+from statcache import StatCache, walk, join_path
+
+
+class HandlerRecord(object):
+	"""A compact record of a file's handler class and constructor args, as stored in a Manifest.
+	Handler objects are only built from these when an operation needs one, see Manifest.get_handler().
+	kwargs is a tuple of (key, value) pairs, since a dict per file would use a lot more memory.
+	"""
+	__slots__ = ('cls', 'args', 'kwargs')
+
+	def __init__(self, cls, args=(), kwargs=()):
+		self.cls = cls
+		self.args = tuple(args)
+		self.kwargs = tuple(kwargs.items() if isinstance(kwargs, dict) else kwargs)
+
+	@property
+	def name(self):
+		return self.cls.name
+
+	def build(self, manifest, path):
+		return self.cls(manifest, path, *self.args, **dict(self.kwargs))
 
 
 class Manifest(object):
 	"""A Manifest contains the list of files and their associated handlers.
 	Manifests can contain absolute or relative paths, but not both.
 	If unspecified, a manifest will adopt the absolute/relative mode depending on the first added path.
+	files maps each path to a HandlerRecord, or None if no handler is set. Use get_handler() to get
+	a handler object for a path.
+	Directories whose handler restores their contents (see HandledByParent) are collapsed: the files inside them
+	are implied by the directory's entry, and aren't listed unless they have a handler of their own.
+	stat_cache is shared by everything that inspects files while this manifest is used,
+	eg. handlers while matching and archiving. See StatCache.
+	Similarly, owner_cache is used to look up user and group names. See OwnerCache.
 	"""
 
 	def __init__(self, filepath=None, absolute=None):
 		"""Filepath arg provides a shortcut to load a manifest from a file"""
 		self.files = {}
 		self.absolute = absolute
+		self.stat_cache = StatCache()
+		self.owner_cache = OwnerCache()
 		if filepath:
 			self.loadfile(filepath)
 
-	def add_file_tree(self, root, follow_symlinks=False):
-		"""Load files and folders recursively, if not already loaded"""
-		# os.walk doesn't handle trivial case of a non-directory
-		if not os.path.isdir(root):
+	def add_file_tree(self, root, follow_symlinks=False, prune=True):
+		"""Load files and folders recursively, if not already loaded. Returns the paths which were added.
+		If prune=True, don't descend into directories whose contents don't need to be listed (see prune_subtree()).
+		"""
+		root = self.normalize_path(root)
+		added = []
+		def add(path):
+			# paths from walk() are already normalised since root is, so we can skip add_file()
+			if path not in self.files:
+				self.files[path] = None
+				added.append(path)
+		# walk doesn't handle trivial case of a non-directory
+		if not self.stat_cache.isdir(root):
 			self.add_file(root, overwrite=False, follow_symlinks=follow_symlinks)
-		for path, dirs, files in os.walk(root, followlinks=follow_symlinks):
+		if prune and self.prune_subtree(root):
+			add(root)
+			return added
+		for path, dirs, files in walk(root, self.stat_cache, followlinks=follow_symlinks):
 			for filename in files:
-				self.add_file(os.path.join(path, filename), overwrite=False)
-			self.add_file(path, overwrite=False, follow_symlinks=follow_symlinks)
-
-	def add_file(self, path, handler=None, overwrite=True, follow_symlinks=False):
-		"""Add path and associate with handler (if any).
-		If path already present and overwrite=False, do nothing.
-		If follow_symlinks=False, the link itself will be added.
-		If follow_symlinks=True, both the link and the path it points to will be added.
+				add(join_path(path, filename))
+			if prune:
+				pruned = set(name for name in dirs if self.prune_subtree(join_path(path, name)))
+				for name in pruned:
+					add(join_path(path, name))
+				dirs[:] = [name for name in dirs if name not in pruned]
+			add(path)
+			if follow_symlinks:
+				self.add_file(path, overwrite=False, follow_symlinks=follow_symlinks)
+		return added
+
+	def prune_subtree(self, path):
+		"""Returns True if the contents of directory path don't need to be listed, because either:
+			its handler restores its contents, or
+			it has no handler yet, and would be ignored according to IgnoreHandler's rules.
+		In the latter case, which handler it gets is still left to find_matches(), which lists
+		its contents after all if it doesn't end up ignored.
 		"""
+		record = self.files.get(path)
+		if record:
+			return getattr(record.cls, 'restores_contents', False)
+		return IgnoreHandler.is_ignored(path)
+
+	def normalize_path(self, path):
+		"""Returns path in the normalised form used for manifest keys, which is absolute or relative
+		according to the manifest's mode."""
 		if self.absolute is None:
 			self.absolute = path.startswith('/')
 
 		path = os.path.normpath(path)
 
 		if self.absolute:
-			path = os.path.abspath(path)
+			return os.path.abspath(path)
 		else:
-			path = os.path.relpath(path)
+			return os.path.relpath(path)
 
-		if follow_symlinks and os.path.islink(path):
+	def add_file(self, path, handler=None, overwrite=True, follow_symlinks=False):
+		"""Add path and associate with handler, a HandlerRecord (if any).
+		If path already present and overwrite=False, do nothing.
+		If follow_symlinks=False, the link itself will be added.
+		If follow_symlinks=True, both the link and the path it points to will be added.
+		"""
+		path = self.normalize_path(path)
+
+		if follow_symlinks and self.stat_cache.islink(path):
 			linked_path = os.path.join(path, os.readlink(path))
 			if os.path.exists(linked_path) or os.path.islink(linked_path):
 				self.add_file(linked_path)
@@ -67,163 +137,296 @@ class Manifest(object):
 			("hello world",), {"foo": "bar"}
 		If no handler is set, the name 'none' is used.
 		The purpose of this format is to be easily hand-editable.
+		For large manifests, prefer iter_dump() or savefile() which don't build the whole output in memory.
 		"""
-		output = ''
-		for path, handler in sorted(self.files.items()):
-			if handler:
-				args, kwargs = handler.get_args()
-				argstr = ", ".join(map(str, args) + ["{}={}".format(k, v) for k, v in kwargs.items()])
-				name = handler.name
-			else:
-				name, argstr = 'none', ''
-			output += "{}\t{}\t{}\n".format(path.encode('string-escape'), name, argstr)
-		return output
+		return ''.join(self.iter_dump())
+
+	def iter_dump(self):
+		"""Yields the lines of the on-disk format, in path order. See dump()."""
+		for path in sorted(self.files):
+			name, argstr = self.format_handler(self.files[path])
+			yield "{}\t{}\t{}\n".format(path.encode('string-escape'), name, argstr)
+
+	@staticmethod
+	def format_handler(record):
+		"""Returns (name, args string) for a HandlerRecord, as used in the on-disk format. See dump()."""
+		if not record:
+			return 'none', ''
+		argstr = ", ".join(map(str, record.args) + ["{}={}".format(k, v) for k, v in record.kwargs])
+		return record.name, argstr
+
+	def get_handler(self, path):
+		"""Returns a new handler object for path, or None if it has no handler.
+		Handlers are built on demand and not kept, so that operations which don't need them
+		(eg. loading and saving) stay cheap for large manifests."""
+		record = self.files.get(path)
+		if not record:
+			return None
+		return record.build(self, path)
+
+	def get_fingerprints(self):
+		"""Yields (path, fingerprint) for every path with a handler that provides a fingerprint
+		(see Handler.get_fingerprint()). The fingerprint returned here also covers the handler and its args.
+		If the fingerprint for a path is unchanged, the extra data for that path is assumed to also be unchanged.
+		"""
+		for path, record in self.files.items():
+			if not record:
+				continue
+			fingerprint = self.get_handler(path).get_fingerprint()
+			if fingerprint is None:
+				continue
+			name, argstr = self.format_handler(record)
+			yield path, "{}\t{}\t{}".format(name, argstr, fingerprint)
 
 	def load(self, data, overwrite=True):
-		"""Takes the string data for the on-disk format and loads it into the object.
+		"""Takes the on-disk format and loads it into the object. data may either be a string,
+		or an iterable of lines such as an open file, which is parsed one line at a time.
 		See dump() for a description of the on-disk format."""
-		for line in filter(None, data.split('\n')):
+		if isinstance(data, basestring):
+			data = StringIO(data)
+		for line in data:
+			line = line.rstrip('\n')
+			if not line:
+				continue
 			parts = line.split('\t')
 			parts = list(parts) + [''] * max(3 - len(parts), 0) # pad to length 3 with ''
 			path, name, args = parts[:3]
 
 			path = path.decode('string-escape')
 
+			# args are interned since many files tend to share the same args, eg. a package name
 			args = filter(None, args.split(','))
-			posargs, kwargs = [], {}
+			posargs, kwargs = [], []
 			for arg in args:
 				if '=' in arg:
 					k, v = arg.split('=', 1)
-					kwargs[k.strip()] = v.strip()
+					kwargs.append((intern(k.strip()), intern(v.strip())))
 				else:
-					posargs.append(arg.strip())
+					posargs.append(intern(arg.strip()))
 
 			if name == 'none' or not name:
-				handler = None
+				record = None
 			else:
-				handler = Handler.from_name(name)(self, path, *posargs, **kwargs)
+				record = HandlerRecord(Handler.from_name(name), posargs, kwargs)
 
-			self.add_file(path, handler, overwrite=overwrite)
+			self.add_file(path, record, overwrite=overwrite)
 
 	def savefile(self, filepath):
-		"""Save manifest to a file"""
-		s = self.dump()
-		with open(filepath, 'w') as f:
-			f.write(s)
+		"""Save manifest to a file.
+		Lines are written out as they are generated. To avoid leaving a partial file if this fails,
+		we write to a temporary file then rename it over the target."""
+		temp_path = '{}.tmp'.format(filepath)
+		try:
+			with open(temp_path, 'w') as f:
+				f.writelines(self.iter_dump())
+			os.rename(temp_path, filepath)
+		except Exception:
+			if os.path.exists(temp_path):
+				os.remove(temp_path)
+			raise
 
 	def loadfile(self, filepath):
-		"""Load data from file and add it to manifest"""
+		"""Load data from file and add it to manifest, one line at a time"""
 		with open(filepath) as f:
-			self.load(f.read())
+			self.load(f)
 
 	def find_matches(self, handlers=DEFAULT_HANDLERS, progress_callback=None, overwrite=False):
 		"""Search handler classes for matches for files.
 		Order in the handlers list determines priority.
-		Parent directories are matched before children (to allow HandledByParent to work)
-		but otherwise matching is done in parallel.
+		Paths are matched one directory level at a time, so parent directories are matched before children
+		(to allow HandledByParent to work), with a fixed pool of workers matching each level in parallel.
+		If HandledByParent is one of the handlers, unmatched paths that it would match are instead removed
+		from the manifest, since they are implied by their parent directory's entry.
 		If given, progress_callback will be called some number of times,
 		with args (number finished, total). The final call will always be (total, total)"""
 		unmatched = [path for path, handler in self.files.items() if overwrite or not handler]
-		ready = {path: Event() for path in unmatched}
 
 		if progress_callback is None:
 			progress_callback = lambda done, total: None
 
 		# a manifest might contain a huge number of files, we can't try to do everything at once
 		# or we will OOM/run out of fds/cause timeouts/etc.
-		# however, we need to be able to proceed with whichever is next in the dependency graph,
-		# so we can only limit concurrency after that check.
 		MAX_CONCURRENCY = int(os.environ.get('MATCH_CONCURRENCY_MAX', 100))
-		semaphore = Semaphore(MAX_CONCURRENCY)
-
-		done = [0] # putting a number inside a list allows us to assign to it from inside a closure
-		           # (since py2 doesn't have a nonlocal keyword)
-		callback_lock = RLock()
+		pool = Pool(MAX_CONCURRENCY)
+
+		# group paths by depth, following the same parent chain as the dependency graph.
+		# '/' or '.' has depth 0, '/foo' or 'foo' depth 1, etc.
+		depths = {}
+		def get_depth(path):
+			chain = []
+			while path not in depths:
+				parent = parent_path(path)
+				if parent is None:
+					depths[path] = 0
+					break
+				chain.append(path)
+				path = parent
+			depth = depths[path]
+			for path in reversed(chain):
+				depth += 1
+				depths[path] = depth
+			return depth
+		levels = {}
+		def add_to_levels(paths):
+			for path in paths:
+				levels.setdefault(get_depth(path), []).append(path)
+		add_to_levels(unmatched)
+		total = len(unmatched)
+
+		def is_unignored(path):
+			# directories which add_file_tree() didn't list the contents of because they looked ignored,
+			# but which matched a handler that doesn't restore their contents, eg. when excluding the ignore handler
+			record = self.files.get(path)
+			return (
+				bool(record) and record.cls is not IgnoreHandler and not getattr(record.cls, 'restores_contents', False)
+				and self.stat_cache.isdir(path) and IgnoreHandler.is_ignored(path)
+			)
 
 		def match_path(path):
-			self.find_match(path, handlers, _ready=ready, _lock=semaphore)
-			done[0] += 1
-			with callback_lock:
-				progress_callback(done[0], len(unmatched))
-
-		progress_callback(0, len(unmatched))
-		gtools.gmap(match_path, unmatched)
-		progress_callback(len(unmatched), len(unmatched))
-
-	def find_match(self, path, handlers=DEFAULT_HANDLERS, _ready=None, _lock=DummySemaphore()):
-		"""Find handler from given list which matches against path and set that handler for that path in manifest.
-		Other args are for internal use only (see find_matches)
-		"""
-		parent = os.path.dirname(path)
-		if _ready and parent in _ready:
-			_ready[parent].wait()
-		with _lock:
-			for cls in handlers:
-				match = cls.match(self, path)
-				if not match: continue
-				args, kwargs = match
-				self.files[path] = cls(self, path, *args, **kwargs)
-				break
-		if _ready:
-			_ready[path].set()
+			self.find_match(path, handlers)
+
+		# paths removed because they are implied by a parent directory
+		collapse = HandledByParent in handlers
+		implied = set()
+
+		def is_implied(path):
+			parent = parent_path(path)
+			if parent is None:
+				return False # root directory
+			if parent in implied:
+				return True
+			record = self.files.get(parent)
+			return bool(record) and getattr(record.cls, 'restores_contents', False)
+
+		done = 0
+		progress_callback(0, total)
+		while levels:
+			level = levels.pop(min(levels))
+			if collapse:
+				# the previous level has been fully matched, so we know which of these paths are implied
+				for path in filter(is_implied, level):
+					del self.files[path]
+					implied.add(path)
+					done += 1
+				if implied:
+					level = [path for path in level if path not in implied]
+				progress_callback(done, total)
+			for _ in pool.imap_unordered(match_path, level):
+				done += 1
+				progress_callback(done, total)
+			# their contents are on deeper levels, so are matched after them as usual
+			for path in filter(is_unignored, level):
+				added = self.add_file_tree(path)
+				add_to_levels(added)
+				total += len(added)
+		progress_callback(total, total)
+
+	def find_match(self, path, handlers=DEFAULT_HANDLERS):
+		"""Find handler from given list which matches against path and set that handler for that path in manifest."""
+		for cls in handlers:
+			match = cls.match(self, path)
+			if not match: continue
+			args, kwargs = match
+			self.files[path] = HandlerRecord(cls, args, kwargs)
+			break
 
 	def restore(self, archive, path):
 		"""Restore target path from given archive. Note this assumes the path's dependencies are already
 		correct."""
-		extra_data = archive.get_extra_data(path)
-		handler = self.files[path]
+		handler = self.get_handler(path)
 		if handler:
-			handler.restore(extra_data)
+			handler.restore_from_history(archive.iter_extra_data_history(path))
 
-	def restore_all(self, archive):
-		"""Restore all files in manifest, using given archive.
+	def restore_all(self, archive, graph=None, concurrency=None, threads=None):
+		"""Restore all files in manifest, using given archive. See pipeline.restore_files() for how they're
+		scheduled, and for the concurrency and threads limits.
+		graph is the manifest's DependencyGraph, if already known.
 		NOTE: Unexpected results may happen if archive was not constructed using the exact same manifest.
 		Generally, you should call archive.restore() instead, as this will force it to use the manifest
 		from the archive itself.
 		"""
-		restored = {path: Event() for path in self.files}
-
-		def wait_and_restore(path):
-			handler = self.files[path]
-			if not handler:
-				return
-			for dependency in handler.get_depends():
-				dependency = os.path.normpath(dependency)
-				if dependency in restored:
-					restored[dependency].wait()
-			self.restore(archive, path)
-			restored[path].set()
-
-		self.check_cycles()
-		gtools.gmap(wait_and_restore, self.files)
-
-	def archive(self, fileobj, compress='gz'):
+		if graph is None:
+			graph = self.get_dependency_graph()
+		graph.check_cycles()
+		restore_files(self, archive, graph, concurrency=concurrency, threads=threads)
+		self.owner_cache.log_stats()
+
+	def archive(self, fileobj, compress='gz', dedup=False, base=None, base_ref=None, chunkstore=None,
+	            compress_level=None):
 		"""Write archive to given fileobj (common use cases include a file on disk, a pipe to a storage service).
 		The archive contains all the info needed for a later restore operation, including the manifest itself.
-		compress enables compression on the output archive and may be one of "gz", "bz2" or None.
+		compress enables compression on the output archive and may be one of "gz", "bz2", "zstd", "lz4" or None,
+		with compress_level overriding the default level for that compression.
+		dedup stores identical data only once, see Archive.
+		base and base_ref make an incremental archive, see Archive.add_manifest().
+		chunkstore stores large data in the given ChunkStore instead of the archive itself.
 		"""
 		# late import breaks cyclic dependency
 		from archive import Archive
-		with Archive(fileobj, 'w', compress=compress) as archive:
-			archive.add_manifest(self)
-
-	def check_cycles(self, path=None, chain=()):
-		"""Check for cycles originating from path, or all paths if path=None"""
-		if path is None:
-			for path in self.files:
-				self.check_cycles(path)
-			return
-
-		if path not in self.files:
-			return
-
-		if path in chain:
-			chain_text = " -> ".join(map(repr, chain + (path,)))
-			raise ValueError("Dependency cycle: {}".format(chain_text))
-
-		for dependency in self.files[path].get_depends():
-			dependency = os.path.normpath(dependency)
-			self.check_cycles(dependency, chain + (path,))
+		with Archive(fileobj, 'w', compress=compress, dedup=dedup, chunkstore=chunkstore,
+		             compress_level=compress_level) as archive:
+			archive.add_manifest(self, base=base, base_ref=base_ref)
+		self.owner_cache.log_stats()
+
+	def get_depends(self, path):
+		"""Returns the normalised dependencies of path that are in the manifest, in sorted order."""
+		handler = self.get_handler(path)
+		if not handler:
+			return []
+		depends = set(os.path.normpath(dependency) for dependency in handler.get_depends())
+		return sorted(dependency for dependency in depends if dependency in self.files)
+
+	def find_restoring_path(self, path):
+		"""Returns the path in the manifest which restores path. This is path itself, or if path is inside
+		a directory whose handler restores its contents (see HandledByParent), that directory.
+		Raises KeyError if there's neither."""
+		path = self.normalize_path(path)
+		record = self.files.get(path)
+		if path in self.files and not (record and record.cls is HandledByParent):
+			return path
+		parent = path
+		while parent not in ('.', '/'):
+			parent = os.path.dirname(parent) or '.'
+			record = self.files.get(parent)
+			if record and record.cls is not HandledByParent and getattr(record.cls, 'restores_contents', False):
+				return parent
+		raise KeyError(path)
+
+	def select_paths(self, graph, paths=(), subtrees=()):
+		"""Returns the set of paths to restore in order to restore the given paths, and every path under
+		the given subtrees, where graph is the manifest's DependencyGraph. See find_restoring_path() for paths
+		that aren't in the manifest themselves. Dependencies of the selected paths are also selected,
+		unless they already exist.
+		Raises KeyError for paths which aren't in the manifest."""
+		selected = set(self.find_restoring_path(path) for path in paths)
+		for root in subtrees:
+			root = self.normalize_path(root)
+			prefix = '' if root == '.' else root.rstrip('/') + '/'
+			contents = [path for path in self.files if path.startswith(prefix)]
+			if root in self.files or not contents:
+				selected.add(self.find_restoring_path(root))
+			selected.update(contents)
+		stack = list(selected)
+		while stack:
+			for dependency in graph.depends[stack.pop()]:
+				if dependency not in selected and not os.path.lexists(dependency):
+					selected.add(dependency)
+					stack.append(dependency)
+		return selected
+
+	def get_dependency_graph(self):
+		"""Returns a DependencyGraph of the paths in the manifest. Build this once and re-use it,
+		rather than calling dependency_order() or check_cycles() repeatedly."""
+		return DependencyGraph.from_manifest(self)
+
+	def dependency_order(self):
+		"""Returns a list of all paths in the manifest, such that each path comes after its dependencies.
+		See DependencyGraph.order()."""
+		return self.get_dependency_graph().order()
+
+	def check_cycles(self):
+		"""Raises ValueError if there are any dependency cycles, listing all of them."""
+		self.get_dependency_graph().check_cycles()
 
 
 class edit_manifest(object):
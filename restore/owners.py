@@ -0,0 +1,92 @@
+
+import grp
+import logging
+import os
+import pwd
+
+
+# Max number of entries in each of the caches in an OwnerCache. May be overridden by env var of the same name.
+OWNER_CACHE_MAX = int(os.environ.get('OWNER_CACHE_MAX', 4096))
+
+logger = logging.getLogger('restore.owners')
+
+
+class LookupCache(object):
+	"""A bounded cache of the results of lookup(key). When full, arbitrary entries are discarded.
+	Lookups which raise KeyError (eg. for a uid with no user) are cached as None, since these are
+	often the slowest lookups of all.
+	This is used from archiving threads, but needs no lock since single dict operations are atomic.
+	At worst, two threads look up the same key at once, or the hit/miss counts are slightly off.
+	"""
+
+	def __init__(self, lookup, max_size=None):
+		self.lookup = lookup
+		self.max_size = OWNER_CACHE_MAX if max_size is None else max_size
+		self.entries = {}
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, key):
+		try:
+			value = self.entries[key]
+		except KeyError:
+			pass
+		else:
+			self.hits += 1
+			return value
+		self.misses += 1
+		try:
+			value = self.lookup(key)
+		except KeyError:
+			value = None
+		while len(self.entries) >= self.max_size:
+			try:
+				self.entries.popitem()
+			except KeyError:
+				break
+		self.entries[key] = value
+		return value
+
+
+class OwnerCache(object):
+	"""Resolves user and group ids to names and back, caching the results.
+	With NSS backends like LDAP, each uncached lookup may take milliseconds,
+	while most files share a handful of owners.
+	Names or ids which don't exist resolve to None.
+	"""
+
+	def __init__(self, max_size=None):
+		self.user_names = LookupCache(lambda uid: pwd.getpwuid(uid).pw_name, max_size)
+		self.group_names = LookupCache(lambda gid: grp.getgrgid(gid).gr_name, max_size)
+		self.uids = LookupCache(lambda name: pwd.getpwnam(name).pw_uid, max_size)
+		self.gids = LookupCache(lambda name: grp.getgrnam(name).gr_gid, max_size)
+
+	def user_name(self, uid):
+		return self.user_names.get(uid)
+
+	def group_name(self, gid):
+		return self.group_names.get(gid)
+
+	def uid(self, name):
+		return self.uids.get(name)
+
+	def gid(self, name):
+		return self.gids.get(name)
+
+	def stats(self):
+		"""Returns {cache name: (hits, misses)} for each cache"""
+		return {
+			name: (cache.hits, cache.misses)
+			for name, cache in (
+				('user_names', self.user_names),
+				('group_names', self.group_names),
+				('uids', self.uids),
+				('gids', self.gids),
+			)
+		}
+
+	def log_stats(self):
+		"""Log the hits and misses of each cache, eg. at the end of an archive or restore"""
+		logger.info("Owner lookup cache hits/misses: {}".format(", ".join(
+			"{} {}/{}".format(name, hits, misses) for name, (hits, misses) in sorted(self.stats().items())
+		)))
@@ -0,0 +1,95 @@
+
+import mmap
+import os
+import tempfile
+
+
+class PathIndex(object):
+	"""A read-only mapping of paths to string values, kept on disk as a sorted text file.
+	Lookups binary search a memory map of the file, so the index is never loaded whole,
+	and only the pages actually searched are read.
+	Each index carries a stamp, an arbitrary string describing what it was built from,
+	which is used to detect when it's out of date (see open()).
+	Format is a header line, then one line per path in sorted order:
+		"restore-path-index 1 {stamp}"
+		"{path}\t{value}"
+	where path is string-escaped (so the order is that of the escaped paths), and value may not contain newlines.
+	"""
+
+	MAGIC = 'restore-path-index 1 '
+
+	def __init__(self, fileobj):
+		self.file = fileobj
+		self.map = mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+		header_end = self.map.find('\n')
+		if not self.map[:header_end].startswith(self.MAGIC):
+			raise ValueError("{!r} is not a path index".format(fileobj.name))
+		self.stamp = self.map[len(self.MAGIC):header_end]
+		self.start = header_end + 1
+
+	@classmethod
+	def open(cls, filepath, stamp):
+		"""Open the index at filepath. Returns None if it doesn't exist, is invalid or has a different stamp."""
+		try:
+			fileobj = open(filepath, 'rb')
+		except (IOError, OSError):
+			return None
+		try:
+			index = cls(fileobj)
+		except (ValueError, EnvironmentError):
+			fileobj.close()
+			return None
+		if index.stamp != stamp:
+			index.close()
+			return None
+		return index
+
+	@classmethod
+	def build(cls, filepath, stamp, items):
+		"""Write a new index to filepath, from an iterable of (path, value).
+		The lines are sorted in memory, but only as one string per path.
+		The file is written to a temporary file and renamed into place, so readers never see a partial index.
+		"""
+		lines = ["{}\t{}\n".format(path.encode('string-escape'), value) for path, value in items]
+		# since the escaped paths never contain characters that sort before a tab,
+		# sorting the whole lines gives the same order as sorting the paths
+		lines.sort()
+		dirname = os.path.dirname(filepath)
+		if dirname and not os.path.isdir(dirname):
+			os.makedirs(dirname)
+		fd, temp_path = tempfile.mkstemp(dir=dirname or '.', prefix='.tmp-')
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				f.write("{}{}\n".format(cls.MAGIC, stamp))
+				f.writelines(lines)
+			os.rename(temp_path, filepath)
+		except Exception:
+			os.remove(temp_path)
+			raise
+
+	def get(self, path, default=None):
+		"""Returns the value for path, or default if it isn't in the index"""
+		key = path.encode('string-escape')
+		data = self.map
+		# lo and hi are always at the start of a line
+		lo, hi = self.start, len(data)
+		while lo < hi:
+			mid = (lo + hi) // 2
+			newline = data.rfind('\n', lo, mid)
+			line_start = lo if newline < 0 else newline + 1
+			line_end = data.find('\n', line_start)
+			line_key, _, value = data[line_start:line_end].partition('\t')
+			if line_key < key:
+				lo = line_end + 1
+			elif line_key > key:
+				hi = line_start
+			else:
+				return value
+		return default
+
+	def __contains__(self, path):
+		return self.get(path) is not None
+
+	def close(self):
+		self.map.close()
+		self.file.close()
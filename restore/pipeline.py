@@ -0,0 +1,282 @@
+
+import functools
+import heapq
+import os
+from itertools import chain
+
+import gevent
+from gevent.lock import Semaphore, DummySemaphore
+from gevent.pool import Pool
+from gevent.queue import Queue
+from gevent.threadpool import ThreadPool
+
+from streams import stream_size, close_stream, close_values, open_stream, SizedReader, SPOOL_MAX_MEMORY
+
+
+# These limits may be overridden by env vars of the same name, or by arguments to collect_extra_data().
+# Max number of handlers gathering extra data at once
+ARCHIVE_CONCURRENCY_MAX = int(os.environ.get('ARCHIVE_CONCURRENCY_MAX', 20))
+# Max number of threads used for handlers which do blocking I/O (see Handler.collect_in_thread)
+ARCHIVE_THREADS_MAX = int(os.environ.get('ARCHIVE_THREADS_MAX', 8))
+# Max number of bytes of file contents that may be read ahead of the archive writer and held in memory
+ARCHIVE_READAHEAD_MAX = int(os.environ.get('ARCHIVE_READAHEAD_MAX', 64 * 1024 * 1024))
+# These limits may be overridden by env vars of the same name, or by arguments to restore_files().
+# Max number of files being restored at once
+RESTORE_CONCURRENCY_MAX = int(os.environ.get('RESTORE_CONCURRENCY_MAX', 64))
+# Max number of threads used for handlers which do blocking I/O (see Handler.restore_in_thread)
+RESTORE_THREADS_MAX = int(os.environ.get('RESTORE_THREADS_MAX', 16))
+
+
+def _preload(fileobj):
+	try:
+		return fileobj.read()
+	finally:
+		close_stream(fileobj)
+
+
+def _spool(value):
+	"""Spool a value of unknown size, returning (value, size). Small values are read into memory,
+	and larger ones are left in a temporary file."""
+	fileobj, size = open_stream(value)
+	if size <= SPOOL_MAX_MEMORY:
+		return _preload(fileobj), size
+	return SizedReader(fileobj, size), size
+
+
+def collect_extra_data(manifest, paths, concurrency=None, threads=None, readahead=None, previous_fingerprints=None):
+	"""Gather extra data for the given paths of manifest ahead of time, in parallel.
+	Yields (path, extra_data) in the same order as paths, so a single consumer can write them out in order.
+	For paths in previous_fingerprints, the handler's get_incremental_extra_data() is used instead of
+	get_extra_data(), see Handler.get_incremental_extra_data().
+	Handlers with collect_in_thread = True are run in a thread pool, others in a greenlet.
+	Small file-like values are also read in the thread pool ahead of time, as long as the total
+	amount read ahead but not yet consumed stays under the readahead limit.
+	Values of unknown size (eg. the output of a subprocess) would need spooling by the consumer to find their size,
+	so they are spooled here instead, in the same thread or greenlet as the handler, so the work producing them
+	happens in parallel. These count against the readahead limit too, unless they are too large to keep in memory.
+	Anything else is left for the consumer to stream.
+	"""
+	if concurrency is None:
+		concurrency = ARCHIVE_CONCURRENCY_MAX
+	if threads is None:
+		threads = ARCHIVE_THREADS_MAX
+	if readahead is None:
+		readahead = ARCHIVE_READAHEAD_MAX
+
+	pool = Pool(concurrency)
+	threadpool = ThreadPool(threads)
+	# jobs are queued in order, and the queue is bounded so finished-but-unconsumed results
+	# (which may hold open files) can't pile up without limit.
+	jobs = Queue(maxsize=concurrency)
+	readahead_used = [0] # putting a number inside a list allows us to assign to it from inside a closure
+
+	def collect(path):
+		handler = manifest.get_handler(path)
+		if previous_fingerprints and path in previous_fingerprints:
+			get_extra_data = functools.partial(handler.get_incremental_extra_data, previous_fingerprints[path])
+		else:
+			get_extra_data = handler.get_extra_data
+		if handler.collect_in_thread:
+			data = threadpool.apply(get_extra_data)
+		else:
+			data = get_extra_data()
+		preloaded = 0
+		try:
+			for key, value in data.items():
+				if hasattr(value, 'read'):
+					size = stream_size(value)
+				elif hasattr(value, '__iter__'):
+					size = getattr(value, 'size', None)
+					if size is not None:
+						continue # iterables of known size can be streamed by the consumer as they are
+				else:
+					continue
+				if size is None:
+					# we don't know how much will end up in memory until it's spooled, so reserve the most it could be
+					if readahead_used[0] + SPOOL_MAX_MEMORY > readahead:
+						continue
+					readahead_used[0] += SPOOL_MAX_MEMORY
+					held = 0
+					try:
+						if handler.collect_in_thread:
+							data[key], size = threadpool.apply(_spool, (value,))
+						else:
+							data[key], size = _spool(value)
+						if size <= SPOOL_MAX_MEMORY:
+							held = size
+					finally:
+						readahead_used[0] += held - SPOOL_MAX_MEMORY
+					preloaded += held
+					continue
+				if size > SPOOL_MAX_MEMORY or readahead_used[0] + size > readahead:
+					continue
+				readahead_used[0] += size
+				preloaded += size
+				data[key] = threadpool.apply(_preload, (value,))
+		except BaseException:
+			# including being killed, in which case the consumer will never see these values
+			close_values(data)
+			raise
+		return path, data, preloaded
+
+	def produce():
+		job = None
+		try:
+			for path in paths:
+				job = pool.spawn(collect, path)
+				jobs.put(job)
+				job = None
+		except gevent.GreenletExit:
+			# the consumer is stopping us and won't read any more, so we mustn't wait for room in the queue,
+			# and the job we were waiting to queue needs cleaning up here.
+			if job is not None:
+				job.kill()
+				if job.successful():
+					close_values(job.value[1])
+			raise
+		except Exception:
+			jobs.put(None)
+			raise
+		jobs.put(None)
+
+	producer = gevent.spawn(produce)
+	try:
+		while True:
+			job = jobs.get()
+			if job is None:
+				break
+			path, data, preloaded = job.get()
+			yield path, data
+			readahead_used[0] -= preloaded
+		producer.get()
+	finally:
+		producer.kill()
+		pool.kill()
+		# close the values of any paths gathered but never consumed, eg. after an error writing an earlier path.
+		# Killed jobs close their own.
+		while not jobs.empty():
+			job = jobs.get()
+			if job is not None and job.successful():
+				close_values(job.value[1])
+		threadpool.kill()
+
+
+def restore_files(manifest, archive, graph, concurrency=None, threads=None):
+	"""Restore all files in manifest from archive, in parallel.
+	Each file's extra data is retrieved from the archive strictly in dependency order, which is the order it appears
+	in the archive, so a compressed archive never has to seek backwards. Each file is then restored once its data
+	is retrieved and its dependencies (as given by graph, the manifest's DependencyGraph) are restored.
+	Both the number of files being restored and the number whose data is retrieved but not yet restored
+	are limited by concurrency.
+	Handlers with restore_in_thread = True are run in a thread pool, others in a greenlet.
+	Handlers with serial_restore = True are only run one at a time.
+	Files with batch_restore handlers are restored together, once per handler class, when all of
+	the batch's dependencies are restored. See Handler.restore_batch().
+	"""
+	if concurrency is None:
+		concurrency = RESTORE_CONCURRENCY_MAX
+	if threads is None:
+		threads = RESTORE_THREADS_MAX
+
+	# Each node of the dependency graph is either a path, or a handler class for a batch of paths.
+	order = graph.order()
+	batches = {} # {handler class: [path]}
+	node_of = {} # {path: node}
+	for path in order:
+		record = manifest.files[path]
+		if record and record.cls.batch_restore:
+			batches.setdefault(record.cls, []).append(path)
+			node_of[path] = record.cls
+		else:
+			node_of[path] = path
+	for paths in batches.values():
+		graph.check_batch_cycles(paths)
+	# position in dependency order, for batches their earliest path
+	positions = {}
+	for position, path in enumerate(order):
+		positions.setdefault(node_of[path], position)
+
+	waiting = {node: 0 for node in positions} # {node: number of dependencies not yet restored}
+	dependents = {} # {node: set of nodes depending on it}
+	for path in order:
+		node = node_of[path]
+		for dependency in graph.depends[path]:
+			dependency = node_of[dependency]
+			if dependency == node or node in dependents.get(dependency, ()):
+				continue
+			waiting[node] += 1
+			dependents.setdefault(dependency, set()).add(node)
+
+	pool = Pool(concurrency)
+	threadpool = ThreadPool(threads)
+	# limits the number of paths whose data has been retrieved, but which aren't restored yet
+	window = Semaphore(concurrency)
+	serial_locks = {} # {handler class: lock}
+	# receives paths as their data is retrieved, and restore greenlets as they finish
+	events = Queue()
+	# batches and paths without a handler don't need their data retrieving
+	unfetched = set(path for path in order if node_of[path] == path and manifest.files[path])
+	fetched = {} # {path: extra data history, with the first extra data already retrieved}
+
+	def fetch():
+		for path in order:
+			if path not in unfetched:
+				continue
+			window.acquire()
+			# this may wait for the data to arrive from a stream
+			history = archive.iter_extra_data_history(path)
+			fetched[path] = chain([next(history)], history)
+			events.put(path)
+
+	def restore(node):
+		if node in batches:
+			cls = node
+			handlers = [manifest.get_handler(path) for path in batches[cls]]
+			with serial_locks.setdefault(cls, Semaphore()) if cls.serial_restore else DummySemaphore():
+				cls.restore_batch(handlers, archive)
+			return node
+		handler = manifest.get_handler(node)
+		if not handler:
+			return node
+		history = fetched.pop(node)
+		cls = type(handler)
+		with serial_locks.setdefault(cls, Semaphore()) if cls.serial_restore else DummySemaphore():
+			if handler.restore_in_thread:
+				threadpool.apply(handler.restore_from_history, (history,))
+			else:
+				handler.restore_from_history(history)
+		window.release()
+		return node
+
+	ready = [] # heap of (position, node) for nodes which can be restored
+	def check_ready(node):
+		if not waiting[node] and node not in unfetched:
+			heapq.heappush(ready, (positions[node], node))
+
+	fetcher = gevent.spawn(fetch)
+	fetcher.link_exception(events.put)
+	try:
+		for node in positions:
+			check_ready(node)
+		running = 0
+		remaining = len(positions)
+		while remaining:
+			while ready and running < concurrency:
+				position, node = heapq.heappop(ready)
+				pool.spawn(restore, node).link(events.put)
+				running += 1
+			event = events.get()
+			if isinstance(event, gevent.Greenlet):
+				node = event.get() # re-raises if the restore (or fetcher) failed
+				running -= 1
+				remaining -= 1
+				for dependent in dependents.get(node, ()):
+					waiting[dependent] -= 1
+					check_ready(dependent)
+			else:
+				unfetched.remove(event)
+				check_ready(event)
+	finally:
+		fetcher.kill()
+		pool.kill()
+		threadpool.kill()
@@ -0,0 +1,163 @@
+
+import os
+from stat import S_IFMT, S_IFDIR, S_IFREG, S_IFLNK, S_ISLNK
+
+# os.scandir is only in python 3.5+, use the backport if it's installed.
+# scandir lets us get the type of each entry from the directory listing, without a stat() per entry.
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+
+# file type for entries which aren't a directory, regular file or symlink, when we don't know exactly what they are
+OTHER = -1
+
+
+class StatCache(object):
+	"""Caches the results of stat calls on paths, so that the many checks made on the same path
+	(eg. by each handler in turn while matching, then again while archiving) only cost one syscall.
+	This is intended to last for a single run, since it never notices changes to the filesystem.
+	In particular, don't use it while restoring.
+	File types may also be recorded from directory listings (see walk()), which avoids needing
+	to stat at all for simple type checks.
+	Results for paths that don't exist (or can't be accessed) are cached as None.
+	"""
+
+	def __init__(self):
+		self._types = {} # {path: file type}, where file type is a S_IFMT() value or OTHER
+		self._lstats = {} # {path: lstat result}
+		self._stats = {} # {path: stat result}, only for symlinks, since otherwise it's the same as the lstat
+
+	def clear(self):
+		self._types.clear()
+		self._lstats.clear()
+		self._stats.clear()
+
+	def record_type(self, path, file_type):
+		self._types[path] = file_type
+
+	def record_lstat(self, path, result):
+		self._lstats[path] = result
+		self._types[path] = S_IFMT(result.st_mode)
+
+	def lstat(self, path):
+		"""As os.lstat(), but returns None instead of raising if path doesn't exist"""
+		try:
+			return self._lstats[path]
+		except KeyError:
+			pass
+		try:
+			result = os.lstat(path)
+		except OSError:
+			result = None
+		self._lstats[path] = result
+		return result
+
+	def stat(self, path):
+		"""As os.stat(), but returns None instead of raising if path doesn't exist or is a broken link"""
+		result = self.lstat(path)
+		if result is None or not S_ISLNK(result.st_mode):
+			return result
+		try:
+			return self._stats[path]
+		except KeyError:
+			pass
+		try:
+			result = os.stat(path)
+		except OSError:
+			result = None
+		self._stats[path] = result
+		return result
+
+	def file_type(self, path, follow_symlinks=True):
+		"""Returns the type of path as a S_IFMT() value (or OTHER), or None if it doesn't exist."""
+		file_type = self._types.get(path)
+		if file_type is None:
+			result = self.lstat(path)
+			if result is None:
+				return None
+			file_type = S_IFMT(result.st_mode)
+		if follow_symlinks and file_type == S_IFLNK:
+			result = self.stat(path)
+			if result is None:
+				return None
+			file_type = S_IFMT(result.st_mode)
+		return file_type
+
+	def exists(self, path):
+		return self.file_type(path) is not None
+
+	def isdir(self, path):
+		return self.file_type(path) == S_IFDIR
+
+	def isfile(self, path):
+		return self.file_type(path) == S_IFREG
+
+	def islink(self, path):
+		return self.file_type(path, follow_symlinks=False) == S_IFLNK
+
+
+def join_path(dirpath, name):
+	# avoid giving children of '.' a './' prefix, so paths stay normalised
+	if dirpath == os.curdir:
+		return name
+	return os.path.join(dirpath, name)
+
+
+def _list_dir(dirpath, stat_cache):
+	"""Yields (name, file type) for each entry in dirpath, recording the types in stat_cache."""
+	if scandir is not None:
+		for entry in scandir(dirpath):
+			# on most filesystems these checks use the type from the directory listing and don't need a syscall
+			if entry.is_symlink():
+				file_type = S_IFLNK
+			elif entry.is_dir(follow_symlinks=False):
+				file_type = S_IFDIR
+			elif entry.is_file(follow_symlinks=False):
+				file_type = S_IFREG
+			else:
+				file_type = OTHER
+			stat_cache.record_type(join_path(dirpath, entry.name), file_type)
+			yield entry.name, file_type
+		return
+	# fallback without scandir: we need one lstat per entry, so keep the whole result
+	for name in os.listdir(dirpath):
+		path = join_path(dirpath, name)
+		try:
+			result = os.lstat(path)
+		except OSError:
+			continue
+		stat_cache.record_lstat(path, result)
+		yield name, S_IFMT(result.st_mode)
+
+
+def walk(top, stat_cache, followlinks=False):
+	"""Like os.walk() in top-down mode, yields (dirpath, dirnames, filenames) for each directory under top,
+	and as with os.walk(), the caller may remove entries from dirnames to avoid descending into them.
+	The type of every entry is recorded in stat_cache, and with scandir available this needs
+	no syscalls beyond listing each directory.
+	Unlike os.walk(), symlinks to directories are only listed in dirnames if followlinks is True.
+	Otherwise they're listed in filenames, like any other non-directory.
+	Directories that can't be listed are skipped.
+	"""
+	stack = [top]
+	while stack:
+		dirpath = stack.pop()
+		dirnames, filenames = [], []
+		try:
+			for name, file_type in _list_dir(dirpath, stat_cache):
+				if file_type == S_IFDIR or (
+					followlinks and file_type == S_IFLNK and stat_cache.isdir(join_path(dirpath, name))
+				):
+					dirnames.append(name)
+				else:
+					filenames.append(name)
+		except OSError:
+			continue
+		yield dirpath, dirnames, filenames
+		# reversed so we visit directories in listing order
+		stack.extend(join_path(dirpath, name) for name in reversed(dirnames))
@@ -0,0 +1,377 @@
+
+import errno
+import hashlib
+import mmap
+import os
+import stat
+import sys
+from collections import deque
+from cStringIO import StringIO
+from tempfile import SpooledTemporaryFile
+
+
+# size of chunks used when copying stream data around
+CHUNK_SIZE = 64 * 1024
+# streams of unknown size are spooled to a temporary file before being written into the archive,
+# since tar needs to know the size up front. Streams smaller than this stay in memory.
+SPOOL_MAX_MEMORY = 1024 * 1024
+# lseek() whence values to find the data and holes in sparse files. Python 2's os module lacks these,
+# and they differ between platforms, so we only use them on Linux.
+if sys.platform.startswith('linux'):
+	SEEK_DATA, SEEK_HOLE = 3, 4
+else:
+	SEEK_DATA = SEEK_HOLE = None
+# FileRange.copy_to() maps at most this much of the source file at a time
+COPY_MAP_SIZE = 64 * 1024 * 1024
+
+
+class ChunkStream(object):
+	"""Wraps an iterable of string chunks as a minimal read-only file-like object.
+	If the total size of the chunks is known in advance, it should be given as size,
+	otherwise it will need to be spooled to find out.
+	"""
+
+	def __init__(self, chunks, size=None):
+		self.chunks = iter(chunks)
+		self.size = size
+		self.buffer = ''
+
+	def read(self, size=-1):
+		if size is None or size < 0:
+			data = self.buffer + ''.join(self.chunks)
+			self.buffer = ''
+			return data
+		parts = [self.buffer]
+		length = len(self.buffer)
+		while length < size:
+			try:
+				chunk = next(self.chunks)
+			except StopIteration:
+				break
+			parts.append(chunk)
+			length += len(chunk)
+		data = ''.join(parts)
+		data, self.buffer = data[:size], data[size:]
+		return data
+
+	def close(self):
+		close = getattr(self.chunks, 'close', None)
+		if close:
+			close()
+
+
+class SizedReader(object):
+	"""Wraps a file-like object with a known number of bytes remaining, so stream_size() doesn't need to
+	look at the file itself (eg. for a SpooledTemporaryFile, which fileno() would force onto disk).
+	Closing it closes fileobj."""
+
+	def __init__(self, fileobj, size):
+		self.fileobj = fileobj
+		self.size = size
+
+	def read(self, size=-1):
+		return self.fileobj.read(size)
+
+	def close(self):
+		self.fileobj.close()
+
+
+class FixedSizeReader(object):
+	"""Wraps a file-like object, reading exactly size bytes from it. Data beyond size is never read,
+	and if fileobj ends early (eg. a file that was truncated after its size was taken), the rest reads as zeros.
+	padded is the number of zero bytes added so far."""
+
+	def __init__(self, fileobj, size):
+		self.fileobj = fileobj
+		self.remaining = size
+		self.padded = 0
+
+	def read(self, size=-1):
+		if size is None or size < 0 or size > self.remaining:
+			size = self.remaining
+		parts = []
+		wanted = size
+		while wanted and not self.padded:
+			chunk = self.fileobj.read(wanted)
+			if not chunk:
+				break
+			parts.append(chunk)
+			wanted -= len(chunk)
+		if wanted:
+			self.padded += wanted
+			parts.append('\0' * wanted)
+		self.remaining -= size
+		return ''.join(parts)
+
+
+def iter_chunks(fileobj, chunk_size=CHUNK_SIZE):
+	"""Yield fixed-size chunks from fileobj until EOF"""
+	while True:
+		chunk = fileobj.read(chunk_size)
+		if not chunk:
+			return
+		yield chunk
+
+
+def find_extents(fileobj):
+	"""For a sparse file, returns a list of (offset, length) for each part of the file which contains data.
+	The holes in between read as zeros, so don't need storing.
+	Returns None if the file has no holes, or if holes can't be found on this platform or filesystem."""
+	if SEEK_DATA is None:
+		return None
+	fd = fileobj.fileno()
+	info = os.fstat(fd)
+	size = info.st_size
+	# a file without holes has enough blocks allocated for its whole size, so we can skip the seeking
+	if info.st_blocks * 512 >= size:
+		return None
+	extents = []
+	offset = 0
+	try:
+		while offset < size:
+			try:
+				offset = os.lseek(fd, offset, SEEK_DATA)
+			except OSError as e:
+				if e.errno != errno.ENXIO:
+					raise
+				break # no data after offset
+			end = min(os.lseek(fd, offset, SEEK_HOLE), size)
+			extents.append((offset, end - offset))
+			offset = end
+	except OSError as e:
+		if e.errno == errno.EINVAL:
+			return None # not supported by the filesystem
+		raise
+	finally:
+		fileobj.seek(0)
+	if extents == [(0, size)]:
+		return None
+	return extents
+
+
+class ExtentReader(object):
+	"""Read-only file-like object which reads the given extents (offset, length) of fileobj, one after another.
+	Closing it closes fileobj."""
+
+	def __init__(self, fileobj, extents):
+		self.fileobj = fileobj
+		self.extents = deque(extents)
+		self.size = sum(length for offset, length in self.extents)
+		self.remaining = 0 # length left to read of the current extent
+
+	def read(self, size=-1):
+		if size is None or size < 0:
+			size = self.size
+		parts = []
+		while size > 0:
+			if not self.remaining:
+				if not self.extents:
+					break
+				offset, self.remaining = self.extents.popleft()
+				self.fileobj.seek(offset)
+			data = self.fileobj.read(min(size, self.remaining))
+			if not data:
+				break # the file has been truncated
+			parts.append(data)
+			self.remaining -= len(data)
+			size -= len(data)
+		return ''.join(parts)
+
+	def close(self):
+		self.fileobj.close()
+
+
+def copy_stream(src, dest, size=None, chunk_size=CHUNK_SIZE):
+	"""Copy from src to dest in chunks, up to size bytes if given. Returns the number of bytes copied.
+	If src is a FileRange and dest is a real file, the data is copied without reading it, see FileRange.copy_to()."""
+	if isinstance(src, FileRange) and isinstance(dest, file):
+		return src.copy_to(dest, size)
+	copied = 0
+	while size is None or copied < size:
+		chunk = src.read(chunk_size if size is None else min(chunk_size, size - copied))
+		if not chunk:
+			break
+		dest.write(chunk)
+		copied += len(chunk)
+	return copied
+
+
+def stream_size(fileobj):
+	"""Try to determine the number of bytes remaining in fileobj without reading it.
+	Returns None if this can't be determined."""
+	size = getattr(fileobj, 'size', None)
+	if size is not None:
+		return size
+	try:
+		fileno = fileobj.fileno()
+	except (AttributeError, IOError, ValueError):
+		return None
+	info = os.fstat(fileno)
+	if not stat.S_ISREG(info.st_mode):
+		return None
+	return info.st_size - fileobj.tell()
+
+
+def open_stream(value):
+	"""Normalise an extra data value to a (fileobj, size) pair.
+	Values may be:
+		a file-like object, which is read from its current position
+		an iterable of string chunks (eg. a generator), optionally with a size attribute
+		anything else, which is converted with str() as a single value.
+	Values of unknown size are spooled so the size can be measured.
+	"""
+	if hasattr(value, 'read'):
+		fileobj = value
+	elif hasattr(value, '__iter__'):
+		fileobj = ChunkStream(value, size=getattr(value, 'size', None))
+	else:
+		value = str(value)
+		return StringIO(value), len(value)
+
+	size = stream_size(fileobj)
+	if size is None:
+		spool = SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+		try:
+			size = copy_stream(fileobj, spool)
+		finally:
+			close_stream(fileobj)
+		spool.seek(0)
+		fileobj = spool
+	return fileobj, size
+
+
+def close_stream(fileobj):
+	close = getattr(fileobj, 'close', None)
+	if close:
+		close()
+
+
+def close_values(data):
+	"""Close any streams among the values of an extra data dict, eg. when they won't be written after all.
+	Errors are ignored, since this is generally done while handling another error."""
+	for value in data.values():
+		try:
+			close_stream(value)
+		except Exception:
+			pass
+
+
+class HashingReader(object):
+	"""Wraps a file-like object, hashing all data as it is read."""
+
+	def __init__(self, fileobj, algorithm='sha256'):
+		self.fileobj = fileobj
+		self.hash = hashlib.new(algorithm)
+
+	def read(self, size=-1):
+		data = self.fileobj.read(size)
+		self.hash.update(data)
+		return data
+
+	def hexdigest(self):
+		return self.hash.hexdigest()
+
+
+class LockedReader(object):
+	"""Wraps a file-like object, holding lock for each read. This allows readers which share
+	an underlying file (eg. members of a tar file) to be read from multiple threads.
+	Other attributes are passed through to the wrapped object."""
+
+	def __init__(self, fileobj, lock):
+		self.fileobj = fileobj
+		self.lock = lock
+
+	def read(self, *args):
+		# args are passed through as given, since eg. tar members don't accept a size of -1
+		with self.lock:
+			return self.fileobj.read(*args)
+
+	def __getattr__(self, attr):
+		return getattr(self.fileobj, attr)
+
+
+class FileRange(object):
+	"""Read-only file-like object for size bytes of fileobj, a real file, starting at offset.
+	Like LockedReader, lock is held while seeking and reading, so the file may be shared between threads.
+	The data can also be copied to another file without passing through Python strings, see copy_to()."""
+
+	def __init__(self, fileobj, offset, size, lock):
+		self.fileobj = fileobj
+		self.offset = offset
+		self.size = size
+		self.lock = lock
+		self.position = 0
+
+	def read(self, size=-1):
+		remaining = self.size - self.position
+		if size is None or size < 0 or size > remaining:
+			size = remaining
+		if not size:
+			return ''
+		with self.lock:
+			self.fileobj.seek(self.offset + self.position)
+			data = self.fileobj.read(size)
+		self.position += len(data)
+		return data
+
+	def tell(self):
+		return self.position
+
+	def copy_to(self, dest, size=None):
+		"""Copy up to size bytes (default all remaining) into dest, a real file, at its current position.
+		The data is written to dest straight from a memory map of our file, so the only copying is done
+		by the kernel. This doesn't move our file's position, so needs no lock.
+		Returns the number of bytes copied."""
+		remaining = self.size - self.position
+		if size is None or size > remaining:
+			size = remaining
+		dest.flush()
+		dest_position = dest.tell()
+		fd = dest.fileno()
+		copied = 0
+		while copied < size:
+			start = self.offset + self.position
+			# maps must start at a multiple of the allocation granularity
+			map_start = start - start % mmap.ALLOCATIONGRANULARITY
+			length = min(size - copied, COPY_MAP_SIZE)
+			data = mmap.mmap(self.fileobj.fileno(), start - map_start + length, access=mmap.ACCESS_READ, offset=map_start)
+			try:
+				written = 0
+				while written < length:
+					written += os.write(fd, buffer(data, start - map_start + written, length - written))
+			finally:
+				data.close()
+			self.position += length
+			copied += length
+		# we wrote to the file descriptor directly, so bring the file object's position up to date
+		dest.seek(dest_position + copied)
+		return copied
+
+
+def hash_stream(fileobj, size=None, algorithm='sha256'):
+	"""Hash the contents of fileobj (up to size bytes, if given), returning the hex digest."""
+	hasher = HashingReader(fileobj, algorithm)
+	while size is None or size > 0:
+		chunk = hasher.read(CHUNK_SIZE if size is None else min(CHUNK_SIZE, size))
+		if not chunk:
+			break
+		if size is not None:
+			size -= len(chunk)
+	return hasher.hexdigest()
+
+
+def make_seekable(fileobj):
+	"""Returns (fileobj, position) for a file-like object that can be seeked back to position.
+	If the given fileobj isn't seekable, its remaining contents are spooled to a temporary file,
+	and the original is closed."""
+	try:
+		return fileobj, fileobj.tell()
+	except (AttributeError, IOError):
+		pass
+	spool = SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+	try:
+		copy_stream(fileobj, spool)
+	finally:
+		close_stream(fileobj)
+	spool.seek(0)
+	return spool, 0
@@ -4,23 +4,30 @@ import sys
 
 import escapes
 import argh
+from gevent.fileobject import FileObject
 
 from restore.manifest import Manifest, edit_manifest
 from restore.handlers import _DEFAULT_HANDLERS, FIRST_HANDLERS, LAST_HANDLERS
 from restore.handler import Handler
 from restore.archive import Archive
+from restore.chunkstore import ChunkStore
 
 
 cli = argh.EntryPoint("restore")
 
 @cli
 @argh.arg('-L', '--follow-symlinks', help='Follow any symbolic links, instead of adding the links themselves')
-def add(manifest, follow_symlinks=False, *path):
-	"""Add files or folders to a manifest file, or create a new manifest if it doesn't exist"""
+@argh.arg('--no-prune', help='Add the contents of all directories, including ignored ones and those whose handler '
+                             'restores their contents')
+def add(manifest, follow_symlinks=False, no_prune=False, *path):
+	"""Add files or folders to a manifest file, or create a new manifest if it doesn't exist.
+	Directories which would be ignored (see the ignore handler) are added without their contents.
+	If matching doesn't end up ignoring them (eg. with --exclude ignore), their contents are listed then.
+	"""
 	manifest_path = manifest
 	manifest = Manifest(manifest_path) if os.path.isfile(manifest_path) else Manifest()
 	for p in path:
-		manifest.add_file_tree(p, follow_symlinks=follow_symlinks)
+		manifest.add_file_tree(p, follow_symlinks=follow_symlinks, prune=not no_prune)
 	manifest.savefile(manifest_path)
 
 @cli
@@ -87,27 +94,107 @@ def list_handlers(quiet=False):
 			description = '(default) ' + description
 		print "{}: {}".format(handler.name, description)
 
+def open_archive(archive_path, chunkstore=None, base_dir=None):
+	"""Open an archive for reading, streaming it from stdin if archive_path is '-'"""
+	if archive_path == '-':
+		archive = Archive(FileObject(sys.stdin), 'r', stream=True, chunkstore=chunkstore)
+	else:
+		archive = Archive.from_file(archive_path, chunkstore=chunkstore)
+	archive.base_dir = base_dir
+	return archive
+
+@cli
+@argh.arg('--chunk-store', help='Read chunked data from this chunk store, instead of the one the archive was written with')
+@argh.arg('--base-dir', help='For incremental archives, find the base archive relative to this directory, instead of '
+                             'the directory containing the archive (or the current directory, when reading from stdin)')
+@argh.arg('--path', action='append', help='Only restore this path, and any missing paths it depends on. '
+                                          'May be given more than once.')
+@argh.arg('--subtree', action='append', help='Only restore this directory and everything under it, '
+                                             'and any missing paths they depend on. May be given more than once.')
+def restore(archive, chunk_store=None, base_dir=None, path=None, subtree=None):
+	"""Restore all contents of the given archive. WARNING: May overwrite existing files.
+	If archive path is '-', read from stdin, restoring files as they arrive.
+	With --path or --subtree, only the data for those paths is read, which for archives read from a file
+	only means decompressing the parts of the archive containing it.
+	Files are restored in parallel, set RESTORE_CONCURRENCY_MAX and RESTORE_THREADS_MAX to limit this.
+	"""
+	chunkstore = ChunkStore(chunk_store) if chunk_store else None
+	archive = open_archive(archive, chunkstore, base_dir)
+	archive.restore(path or (), subtree or ())
+
 @cli
-def restore(archive):
-	"""Restore all contents of the given archive. WARNING: May overwrite existing files."""
-	archive_path = archive
-	archive = Archive.from_file(archive_path)
-	archive.restore()
+@argh.named('list')
+def list_archive(archive):
+	"""List the paths in the given archive and their handlers, in the same format as a manifest.
+	For archives with an index, only the index and the start of the archive are read. If archive path is '-', read from stdin.
+	"""
+	with open_archive(archive) as archive:
+		for line in archive.get_manifest().iter_dump():
+			sys.stdout.write(line)
 
 @cli
-@argh.arg('--compress', choices=['gz', 'bz2', 'none'], help='Compression algorithm to use for the archive')
-def archive(manifest, archive, compress='gz'):
+@argh.arg('--compress', choices=['gz', 'bz2', 'zstd', 'lz4', 'none'], help='Compression algorithm to use for the archive')
+@argh.arg('--level', type=int, help='Compression level, defaults depend on the compression algorithm')
+@argh.arg('--dedup', help='Store identical data only once. Such archives cannot be restored from stdin.')
+@argh.arg('--base', help='Make an incremental archive, only storing data that has changed since this previous archive. '
+                         'The previous archive must still be present when restoring.')
+@argh.arg('--chunk-store', help='Store large data in this directory, split into chunks which are shared between '
+                                'all archives using the same chunk store. Only the list of chunks is kept in the archive.')
+def archive(manifest, archive, compress='gz', level=None, dedup=False, base=None, chunk_store=None):
 	"""Store backup info for manifest into an archive, which can be used to later restore the data.
 	If archive path is '-', output to stdout.
+	Compression uses multiple threads, set COMPRESS_THREADS_MAX to limit this.
 	"""
 	manifest = Manifest(manifest)
 	if compress == 'none':
 		compress = None
-	if archive == '-':
-		manifest.archive(sys.stdout, compress=compress)
-	else:
-		with open(archive, 'w') as f:
-			manifest.archive(f, compress=compress)
+	base_archive = base_ref = None
+	if base:
+		# we only need the metadata at the start of the base archive, so don't read the whole thing
+		base_archive = Archive.from_file(base, stream=True)
+		# the base is recorded relative to the new archive, so they can be moved together
+		if archive == '-':
+			base_ref = os.path.abspath(base)
+		else:
+			base_ref = os.path.relpath(base, os.path.dirname(os.path.abspath(archive)))
+	chunkstore = ChunkStore(chunk_store) if chunk_store else None
+	options = dict(compress=compress, compress_level=level, dedup=dedup, base=base_archive, base_ref=base_ref,
+	               chunkstore=chunkstore)
+	try:
+		if archive == '-':
+			manifest.archive(sys.stdout, **options)
+		else:
+			with open(archive, 'w') as f:
+				manifest.archive(f, **options)
+	finally:
+		if base_archive:
+			base_archive.close()
+
+@cli
+def gc_chunks(chunk_store, *archives):
+	"""Remove all chunks from a chunk store which aren't used by any of the given archives
+	(or their base archives, for incremental archives).
+	Every archive still in use with this chunk store must be listed.
+	WARNING: Any other archives using the chunk store will no longer be able to be restored.
+	"""
+	if not archives:
+		# with nothing referenced, every chunk would be removed
+		raise argh.CommandError("At least one archive must be given, or every chunk in the store would be removed")
+	referenced = set()
+	seen = set()
+	for archive_path in archives:
+		with Archive.from_file(archive_path) as top:
+			# follow the chain of base archives, since they hold data for unchanged files
+			archive = top
+			while archive is not None:
+				filepath = os.path.realpath(archive.filepath)
+				if filepath in seen:
+					break
+				seen.add(filepath)
+				referenced |= archive.get_chunk_refs()
+				archive = archive.get_base() if archive.is_incremental() else None
+	removed = ChunkStore(chunk_store).gc(referenced)
+	print "Removed {} unused chunks".format(removed)
 
 if __name__ == '__main__':
 	cli()
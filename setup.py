@@ -1,8 +1,15 @@
-from setuptools import setup, find_packages
+from setuptools import setup, find_packages, Extension
 
 setup(
 	name='restore',
 	description='Application to assist in backing up and restoring highly-recoverable data',
 	requires=['gevent(>=1.0)', 'argh'],
+	extras_require={
+		'zstd': ['zstandard'],
+		'lz4': ['lz4'],
+		'scandir': ['scandir'],
+	},
 	packages=find_packages(),
+	# speeds up chunking for chunk stores. It's optional, with a pure python fallback.
+	ext_modules=[Extension('restore._gear', ['restore/_gear.c'], optional=True)],
 )